@@ -4,8 +4,10 @@ from utils.state_utils import validate_agent_return, safe_state_update
 import ast
 import re
 
+_FENCE_RE = re.compile(r"^```[a-zA-Z]*\n?|```$", re.MULTILINE)
+
 def clean_llm_output(text):
-    return re.sub(r'^```[a-zA-Z]*\n?|```$', '', text.strip(), flags=re.MULTILINE).strip()
+    return _FENCE_RE.sub('', text.strip()).strip()
 
 def artist_style_agent(state: dict) -> dict:
     """
@@ -2,28 +2,33 @@ import logging
 from typing import Any
 from utils.gemini_llm import gemini_generate
 from utils.state_utils import validate_agent_return, safe_state_update
+from utils.midi_utils import nearest_onsets
 import ast
 import re
 import json
+from functools import lru_cache
+import numpy as np
+
+_FENCE_RE = re.compile(r"^```[a-zA-Z]*\n?|```$", re.MULTILINE)
 
 def clean_llm_output(text):
-    return re.sub(r"^```[a-zA-Z]*\n?|```$", "", text.strip(), flags=re.MULTILINE).strip()
+    return _FENCE_RE.sub("", text.strip()).strip()
 
 def safe_literal_eval(text):
-    # Try normal parse
+    # Auto-close truncated output before the first parse
+    missing_square = text.count('[') - text.count(']')
+    missing_curly = text.count('{') - text.count('}')
+    if missing_square > 0 or missing_curly > 0:
+        repaired = text + (']' * max(missing_square, 0)) + ('}' * max(missing_curly, 0))
+        try:
+            return ast.literal_eval(repaired)
+        except Exception:
+            pass  # Fall back to the raw text
     try:
         return ast.literal_eval(text)
-    except Exception:
-        # Try to auto-close brackets
-        if text.count('[') > text.count(']'):
-            text = text + (']' * (text.count('[') - text.count(']')))
-        if text.count('{') > text.count('}'):
-            text = text + ('}' * (text.count('{') - text.count('}')))
-        try:
-            return ast.literal_eval(text)
-        except Exception as e:
-            logging.error(f"[ChordAgent] Failed to parse LLM output after auto-fix: {e}")
-            return []
+    except Exception as e:
+        logging.error(f"[ChordAgent] Failed to parse LLM output after auto-fix: {e}")
+        return []
 
 def notes_array_to_dicts(notes_array):
     return [
@@ -31,6 +36,18 @@ def notes_array_to_dicts(notes_array):
         for n in notes_array if isinstance(n, (list, tuple)) and len(n) == 4
     ]
 
+@lru_cache(maxsize=256)
+def parse_pattern_data(pattern_json):
+    """
+    Decode a RAG pattern_data JSON string, or {} if it is not valid JSON. Memoized because
+    chord_agent reads each progression and segment in several passes, so the result is shared
+    and must not be mutated.
+    """
+    try:
+        return json.loads(pattern_json)
+    except Exception:
+        return {}
+
 def chord_agent(state: Any) -> Any:
     """
     Generate sophisticated harmonic progressions with style-specific voicings and complexity.
@@ -86,26 +103,28 @@ def chord_agent(state: Any) -> Any:
         # Section-specific harmonic planning
         section_instructions = ""
         if structured_sections and len(structured_sections) > 2:
-            section_instructions = "\nCREATE HARMONIC VARIATION FOR EACH SECTION:\n"
+            section_lines = ["\nCREATE HARMONIC VARIATION FOR EACH SECTION:\n"]
             for section in structured_sections:
                 section_start = section['start_time']
                 section_end = section['end_time']
                 section_name = section['name'].upper()
+                section_name_lower = section['name'].lower()
                 
-                if 'verse' in section['name'].lower():
+                if 'verse' in section_name_lower:
                     harm_approach = "stable, foundational progressions, moderate voice leading"
-                elif 'chorus' in section['name'].lower():
+                elif 'chorus' in section_name_lower:
                     harm_approach = "stronger progressions, higher voicings, more energy"
-                elif 'bridge' in section['name'].lower():
+                elif 'bridge' in section_name_lower:
                     harm_approach = "contrasting harmony, possible key change, unique progressions"
-                elif 'intro' in section['name'].lower():
+                elif 'intro' in section_name_lower:
                     harm_approach = "establishing key center, building harmonic foundation"
-                elif 'outro' in section['name'].lower():
+                elif 'outro' in section_name_lower:
                     harm_approach = "resolving progressions, possible extension or fade harmony"
                 else:
                     harm_approach = "section-appropriate harmonic support"
                 
-                section_instructions += f"- {section_name} ({section_start:.1f}s-{section_end:.1f}s): {harm_approach}\n"
+                section_lines.append(f"- {section_name} ({section_start:.1f}s-{section_end:.1f}s): {harm_approach}\n")
+            section_instructions = "".join(section_lines)
         
         # Timing alignment strategy
         timing_strategy = ""
@@ -147,10 +166,7 @@ def chord_agent(state: Any) -> Any:
                 for i, progression in enumerate(rag_progressions[:3]):  # Top 3 progressions
                     pattern_data = progression.get('pattern_data', {})
                     if isinstance(pattern_data, str):
-                        try:
-                            pattern_data = json.loads(pattern_data)
-                        except:
-                            pattern_data = {}
+                        pattern_data = parse_pattern_data(pattern_data)
                     
                     # Get actual chord data
                     chords = pattern_data.get('chords', [])
@@ -178,10 +194,7 @@ def chord_agent(state: Any) -> Any:
                 for segment in rag_segments:
                     pattern_data = segment.get('pattern_data', {})
                     if isinstance(pattern_data, str):
-                        try:
-                            pattern_data = json.loads(pattern_data)
-                        except:
-                            pattern_data = {}
+                        pattern_data = parse_pattern_data(pattern_data)
                     
                     # Look for chord data in the segment
                     if 'chord_sequence' in pattern_data:
@@ -373,10 +386,7 @@ def chord_agent(state: Any) -> Any:
                 for i, progression in enumerate(rag_progressions[:3]):  # Top 3 progressions
                     pattern_data = progression.get('pattern_data', {})
                     if isinstance(pattern_data, str):
-                        try:
-                            pattern_data = json.loads(pattern_data)
-                        except:
-                            pattern_data = {}
+                        pattern_data = parse_pattern_data(pattern_data)
                     
                     # Get actual chord data
                     chords = pattern_data.get('chords', [])
@@ -404,10 +414,7 @@ def chord_agent(state: Any) -> Any:
                 for segment in rag_segments:
                     pattern_data = segment.get('pattern_data', {})
                     if isinstance(pattern_data, str):
-                        try:
-                            pattern_data = json.loads(pattern_data)
-                        except:
-                            pattern_data = {}
+                        pattern_data = parse_pattern_data(pattern_data)
                     
                     # Look for chord data in the segment
                     if 'chord_sequence' in pattern_data:
@@ -448,10 +455,7 @@ def chord_agent(state: Any) -> Any:
         for progression in rag_progressions:
             pattern_data = progression.get('pattern_data', {})
             if isinstance(pattern_data, str):
-                try:
-                    pattern_data = json.loads(pattern_data)
-                except:
-                    pattern_data = {}
+                pattern_data = parse_pattern_data(pattern_data)
             
             # Extract chord sequence
             chords = pattern_data.get('chords', [])
@@ -467,10 +471,7 @@ def chord_agent(state: Any) -> Any:
         for segment in rag_segments:
             pattern_data = segment.get('pattern_data', {})
             if isinstance(pattern_data, str):
-                try:
-                    pattern_data = json.loads(pattern_data)
-                except:
-                    pattern_data = {}
+                pattern_data = parse_pattern_data(pattern_data)
             
             # Check for chord_sequence in segments
             if 'chord_sequence' in pattern_data:
@@ -580,33 +581,42 @@ def chord_agent(state: Any) -> Any:
             # Sort by start time
             notes.sort(key=lambda n: n['start'])
             
+            # Quantize to musical grid (quarter-note), on whole columns in place;
+            # rint rounds half to even like round()
+            starts = np.fromiter((note['start'] for note in notes), np.float64, len(notes))
+            ends = np.fromiter((note['end'] for note in notes), np.float64, len(notes))
+            for times in (starts, ends):
+                np.multiply(times, 4.0, out=times)
+                np.rint(times, out=times)
+                np.multiply(times, 0.25, out=times)
+            
+            # Ensure minimum chord duration
+            np.copyto(ends, starts + 1.0, where=ends <= starts)  # Minimum 1-second chords
+            
             # Validate and adjust chord notes
-            for note in notes:
-                # Quantize to musical grid
-                note['start'] = round(note['start'] * 4) / 4  # Quarter-note grid
-                note['end'] = round(note['end'] * 4) / 4
-                
-                # Ensure minimum chord duration
-                if note['end'] <= note['start']:
-                    note['end'] = note['start'] + 1.0  # Minimum 1-second chords
+            for note, start, end in zip(notes, starts.tolist(), ends.tolist()):
+                note['start'] = start
+                note['end'] = end
                 
                 # Validate pitch range for chord voicings
-                note['pitch'] = max(36, min(84, note['pitch']))  # C2 to C6
+                pitch = note['pitch']
+                note['pitch'] = 36 if pitch < 36 else (84 if pitch > 84 else pitch)  # C2 to C6
                 
                 # Adjust velocity for harmonic support role
-                note['velocity'] = max(60, min(90, note['velocity']))
+                velocity = note['velocity']
+                note['velocity'] = 60 if velocity < 60 else (90 if velocity > 90 else velocity)
             
             # Optionally align to melody onsets for better coordination
             if melody_onsets:
-                for note in notes:
-                    # Find closest melody onset
-                    closest_onset = min(melody_onsets, key=lambda t: abs(t - note['start']))
-                    # Only snap if reasonably close (within 0.5 seconds)
-                    if abs(note['start'] - closest_onset) <= 0.5:
+                closest_onsets = nearest_onsets(starts, melody_onsets)
+                # Only snap if reasonably close (within 0.5 seconds)
+                snap = np.abs(starts - closest_onsets) <= 0.5
+                for note, closest_onset, do_snap in zip(notes, closest_onsets.tolist(), snap.tolist()):
+                    if do_snap:
                         note['start'] = closest_onset
             
-            # Check coverage
-            max_end = max(n['end'] for n in notes)
+            # Check coverage on the end column (melody snapping only moves starts)
+            max_end = float(ends.max())
             target_duration = duration * 60
             coverage_ratio = max_end / target_duration
             
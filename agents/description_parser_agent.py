@@ -10,6 +10,8 @@ from typing import Any, Dict, List, Optional
 from utils.gemini_llm import gemini_generate
 import json
 
+_JSON_OBJECT_RE = re.compile(r'\{.*\}', re.DOTALL)
+
 def description_parser_agent(state: Dict) -> Dict:
     """
     Parse natural language song description and extract musical parameters
@@ -130,7 +132,7 @@ def parse_description_with_llm(description: str) -> Dict:
         
         # Try to parse JSON from the response
         # Sometimes the LLM includes extra text, so we need to extract just the JSON
-        json_match = re.search(r'\{.*\}', response, re.DOTALL)
+        json_match = _JSON_OBJECT_RE.search(response)
         if json_match:
             json_str = json_match.group()
             parsed_data = json.loads(json_str)
@@ -384,7 +386,7 @@ def advanced_description_parser_agent(state: Dict) -> Dict:
         response = gemini_generate(detailed_prompt)
         
         # Parse the detailed response
-        json_match = re.search(r'\{.*\}', response, re.DOTALL)
+        json_match = _JSON_OBJECT_RE.search(response)
         if json_match:
             json_str = json_match.group()
             detailed_data = json.loads(json_str)
@@ -2,24 +2,39 @@ import logging
 from typing import Any
 from utils.gemini_llm import gemini_generate
 import ast
+import itertools
 import re
+import string
+import numpy as np
+
+# One complete numeric [pitch, start, end, velocity] row of the drum output
+_NUMBER = r"\s*(-?(?:\d+\.?\d*|\.\d+))\s*"
+_DRUM_ROW_RE = re.compile(r"\[" + r",".join([_NUMBER] * 4) + r"\]")
 
 def clean_llm_output(text):
-    return re.sub(r"^```[a-zA-Z]*\n?|```$", "", text.strip(), flags=re.MULTILINE).strip()
+    # Gemini only fences the whole response, so plain prefix/suffix checks suffice
+    text = text.strip()
+    if text.startswith("```"):
+        text = text[3:].lstrip(string.ascii_letters).removeprefix("\n")
+    if text.endswith("```"):
+        text = text[:-3]
+    return text.strip()
 
 def safe_literal_eval(text):
+    # Auto-close truncated output before the first parse
+    missing_square = text.count('[') - text.count(']')
+    missing_curly = text.count('{') - text.count('}')
+    if missing_square > 0 or missing_curly > 0:
+        repaired = text + (']' * max(missing_square, 0)) + ('}' * max(missing_curly, 0))
+        try:
+            return ast.literal_eval(repaired)
+        except Exception:
+            pass  # Fall back to the raw text
     try:
         return ast.literal_eval(text)
-    except Exception:
-        if text.count('[') > text.count(']'):
-            text = text + (']' * (text.count('[') - text.count(']')))
-        if text.count('{') > text.count('}'):
-            text = text + ('}' * (text.count('{') - text.count('}')))
-        try:
-            return ast.literal_eval(text)
-        except Exception as e:
-            logging.error(f"[DrumAgent] Failed to parse LLM output after auto-fix: {e}")
-            return []
+    except Exception as e:
+        logging.error(f"[DrumAgent] Failed to parse LLM output after auto-fix: {e}")
+        return []
 
 def notes_array_to_dicts(notes_array):
     return [
@@ -27,6 +42,18 @@ def notes_array_to_dicts(notes_array):
         for n in notes_array if isinstance(n, (list, tuple)) and len(n) == 4
     ]
 
+def parse_drum_rows(text):
+    """
+    Scan the drum output for complete numeric rows in a single regex pass and
+    return them as an (N, 4) float64 array, along with how many bracketed rows
+    (besides the outer list) the scan could not read, e.g. truncated or non-numeric ones.
+    """
+    rows = _DRUM_ROW_RE.findall(text)
+    skipped = max(text.count('[') - 1 - len(rows), 0)
+    if not rows:
+        return np.empty((0, 4), dtype=np.float64), skipped
+    return np.array(rows, dtype=np.float64), skipped
+
 def drum_agent(state: Any) -> Any:
     """
     Generate dynamic, style-specific drum patterns with sophisticated rhythmic complexity.
@@ -87,26 +114,28 @@ def drum_agent(state: Any) -> Any:
         # Section-specific drum arrangement
         section_instructions = ""
         if structured_sections and len(structured_sections) > 2:
-            section_instructions = "\nCREATE RHYTHMIC VARIATION FOR EACH SECTION:\n"
+            section_lines = ["\nCREATE RHYTHMIC VARIATION FOR EACH SECTION:\n"]
             for section in structured_sections:
                 section_start = section['start_time']
                 section_end = section['end_time']
                 section_name = section['name'].upper()
+                section_name_lower = section['name'].lower()
                 
-                if 'verse' in section['name'].lower():
+                if 'verse' in section_name_lower:
                     drum_approach = "solid foundation, moderate energy, subtle variations"
-                elif 'chorus' in section['name'].lower():
+                elif 'chorus' in section_name_lower:
                     drum_approach = "increased energy, stronger accents, fuller sound"
-                elif 'bridge' in section['name'].lower():
+                elif 'bridge' in section_name_lower:
                     drum_approach = "contrasting rhythm, possible breaks, unique patterns"
-                elif 'intro' in section['name'].lower():
+                elif 'intro' in section_name_lower:
                     drum_approach = "building energy, establishing groove, gradual entrance"
-                elif 'outro' in section['name'].lower():
+                elif 'outro' in section_name_lower:
                     drum_approach = "maintaining or reducing energy, possible fade or ending fill"
                 else:
                     drum_approach = "section-appropriate rhythmic support"
                 
-                section_instructions += f"- {section_name} ({section_start:.1f}s-{section_end:.1f}s): {drum_approach}\n"
+                section_lines.append(f"- {section_name} ({section_start:.1f}s-{section_end:.1f}s): {drum_approach}\n")
+            section_instructions = "".join(section_lines)
         
         # Build comprehensive prompt
         context_description = f"""
@@ -126,6 +155,12 @@ def drum_agent(state: Any) -> Any:
         {f'- Performance Notes: {instrument_description}' if instrument_description else ''}
         """
         
+        # Bar structure block (skipped entirely when no bar grid is known)
+        bar_block = ""
+        if len(bar_times):
+            bar_block = ("BAR STRUCTURE:\n        Align major pattern changes to bar times: "
+                         + ", ".join(f"{t:.2f}" for t in itertools.islice(bar_times, 12)) + "...")
+        
         final_prompt = f"""
         {context_description}
         
@@ -137,8 +172,7 @@ def drum_agent(state: Any) -> Any:
         DYNAMIC APPROACH:
         {dynamic_instruction}
         
-        BAR STRUCTURE:
-        Align major pattern changes to bar times: {bar_times[:12]}...
+        {bar_block}
         
         GENRE-SPECIFIC DRUM REQUIREMENTS FOR {genre.upper()}:
         """
@@ -282,34 +316,49 @@ def drum_agent(state: Any) -> Any:
         logging.info(f"[DrumAgent] Raw Gemini output preview: {drum_text[:200]}...")
         
         cleaned = clean_llm_output(drum_text)
-        notes_array = safe_literal_eval(cleaned)
-        notes = notes_array_to_dicts(notes_array)
+        rows, skipped_rows = parse_drum_rows(cleaned)
+        notes = [
+            {'pitch': int(p), 'start': s, 'end': e, 'velocity': int(v)}
+            for p, s, e, v in rows.tolist()
+        ]
+        if skipped_rows or not notes:
+            # Fall back to the literal parser for anything the row scanner can't read,
+            # keeping the scanned rows if that recovers fewer notes
+            literal_notes = notes_array_to_dicts(safe_literal_eval(cleaned))
+            if len(literal_notes) >= len(notes):
+                notes = literal_notes
+            else:
+                logging.warning(f"[DrumAgent] Skipped {skipped_rows} unreadable drum rows")
         
         # Post-process drum notes
         if notes:
             # Sort by start time
             notes.sort(key=lambda n: n['start'])
             
+            # Quantize to tight rhythmic grid (16th notes), on whole columns at once
+            sixteenth_duration = 60.0 / tempo / 4
+            starts = np.fromiter((note['start'] for note in notes), np.float64, len(notes))
+            ends = np.fromiter((note['end'] for note in notes), np.float64, len(notes))
+            starts = np.rint(starts / sixteenth_duration) * sixteenth_duration
+            
+            # Ensure appropriate drum note durations
+            ends = np.where(ends <= starts, starts + 0.1, np.minimum(ends, starts + 0.5))  # Short hits, max duration
+            
             # Validate and adjust drum notes
-            for note in notes:
-                # Quantize to tight rhythmic grid (16th notes)
-                sixteenth_duration = 60.0 / tempo / 4
-                note['start'] = round(note['start'] / sixteenth_duration) * sixteenth_duration
-                
-                # Ensure appropriate drum note durations
-                if note['end'] <= note['start']:
-                    note['end'] = note['start'] + 0.1  # Short drum hits
-                else:
-                    note['end'] = min(note['end'], note['start'] + 0.5)  # Max duration
+            for note, start, end in zip(notes, starts.tolist(), ends.tolist()):
+                note['start'] = start
+                note['end'] = end
                 
-                # Validate drum MIDI range
-                note['pitch'] = max(35, min(81, note['pitch']))  # Standard drum range
+                # Validate drum MIDI range (35-81 standard drum range)
+                pitch = note['pitch']
+                note['pitch'] = 35 if pitch < 35 else (81 if pitch > 81 else pitch)
                 
                 # Ensure realistic velocity range
-                note['velocity'] = max(40, min(127, note['velocity']))
+                velocity = note['velocity']
+                note['velocity'] = 40 if velocity < 40 else (127 if velocity > 127 else velocity)
             
             # Check coverage and density
-            max_end = max(n['end'] for n in notes)
+            max_end = float(ends.max())
             target_duration = duration * 60
             coverage_ratio = max_end / target_duration
             
@@ -1,8 +1,7 @@
 import logging
 from typing import Any
 import os
-import json
-from utils.state_utils import validate_agent_return, safe_state_update
+from utils.state_utils import safe_state_update
 
 def export_agent(state: Any) -> Any:
     """
@@ -12,8 +11,9 @@ def export_agent(state: Any) -> Any:
     logging.info("[ExportAgent] Exporting generated files and preserving RAG patterns")
     
     try:
-        # Log all keys in the state at the export stage
-        logging.info(f"[ExportAgent] Final state keys: {list(state.keys())}")
+        # Log all keys in the state at the export stage (diagnostic only)
+        if logging.getLogger().isEnabledFor(logging.DEBUG):
+            logging.debug("[ExportAgent] Final state keys: %s", list(state.keys()))
         
         # Get output paths
         midi_path = state.get('midi_path')
@@ -42,18 +42,21 @@ def export_agent(state: Any) -> Any:
         # Preserve RAG patterns in the result
         if 'rag_patterns' in state:
             rag_patterns = state['rag_patterns']
-            logging.info(f"[ExportAgent] Preserving RAG patterns in result: {rag_patterns['metadata'] if isinstance(rag_patterns, dict) and 'metadata' in rag_patterns else 'unknown structure'}")
             result['rag_patterns'] = rag_patterns
             
-            # Count patterns by type for logging
-            if isinstance(rag_patterns, dict):
-                segments_count = len(rag_patterns.get('segments', []))
-                progressions_count = len(rag_patterns.get('progressions', []))
-                melodies_count = len(rag_patterns.get('melodies', []))
-                total_patterns = segments_count + progressions_count + melodies_count
+            # Verbose RAG metadata and per-type counts are only built when INFO is enabled
+            if logging.getLogger().isEnabledFor(logging.INFO):
+                logging.info("[ExportAgent] Preserving RAG patterns in result: %s",
+                             rag_patterns['metadata'] if isinstance(rag_patterns, dict) and 'metadata' in rag_patterns else 'unknown structure')
                 
-                logging.info(f"[ExportAgent] RAG pattern counts: segments={segments_count}, "
-                           f"progressions={progressions_count}, melodies={melodies_count}, total={total_patterns}")
+                if isinstance(rag_patterns, dict):
+                    segments_count = len(rag_patterns.get('segments', []))
+                    progressions_count = len(rag_patterns.get('progressions', []))
+                    melodies_count = len(rag_patterns.get('melodies', []))
+                    total_patterns = segments_count + progressions_count + melodies_count
+                    
+                    logging.info(f"[ExportAgent] RAG pattern counts: segments={segments_count}, "
+                               f"progressions={progressions_count}, melodies={melodies_count}, total={total_patterns}")
         else:
             logging.warning("[ExportAgent] No RAG patterns found in state!")
             
@@ -1,50 +1,226 @@
 import logging
 from typing import Any
-from utils.gemini_llm import gemini_generate
+from utils.gemini_llm import cached_gemini_generate_stream
 from agents.rag_midi_reference_agent import get_rag_patterns_for_instrument
 from utils.state_utils import validate_agent_return, safe_state_update
+from utils.midi_utils import NOTE_NAME_TO_MIDI
 import ast
+import json
 import re
+from functools import lru_cache
+from operator import itemgetter
+from types import MappingProxyType
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import numpy as np
 
-def clean_llm_output(text):
-    return re.sub(r"^```[a-zA-Z]*\n?|```$", "", text.strip(), flags=re.MULTILINE).strip()
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+_FENCE_RE = re.compile(r"^[ \t]*```[a-zA-Z]*\n?|```[ \t]*$", re.MULTILINE)
+
+_JSON_DECODER = json.JSONDecoder()
+
+# orjson parses long numeric arrays several times faster than the stdlib decoder when it is installed
+_json_loads = orjson.loads if orjson is not None else json.loads
+
+# Instrument names that belong to the drum agent rather than this one
+_DRUM_NAMES = frozenset({'drums', 'percussion', 'drum kit', 'drum_kit'})
+
+# Instrument families with dedicated prompt guidance, checked in this order
+_INSTRUMENT_FAMILIES = ('guitar', 'piano', 'bass')
+
+def instrument_family(instrument_lower):
+    """The first family named in a lower-cased instrument name, or 'other'."""
+    return next((family for family in _INSTRUMENT_FAMILIES if family in instrument_lower), 'other')
+
+# Orchestral sections within the 'other' family whose parts can double each other, checked in this order
+_DOUBLING_FAMILIES = (
+    ('bowed_strings', ('violin', 'viola', 'cello', 'fiddle')),
+    ('brass', ('trumpet', 'trombone', 'tuba', 'flugelhorn', 'cornet', 'french horn', 'french_horn')),
+    ('woodwinds', ('flute', 'piccolo', 'clarinet', 'oboe')),
+)
+
+def doubling_family(instrument_lower):
+    """The orchestral section a lower-cased 'other'-family instrument name belongs to, or None."""
+    return next((section for section, names in _DOUBLING_FAMILIES
+                 if any(name in instrument_lower for name in names)), None)
+
+# Section kinds with dedicated arrangement guidance, checked in this order
+_SECTION_KINDS = ('verse', 'chorus', 'bridge', 'intro', 'outro')
+
+# Arrangement approach per (section kind, is lead part)
+_SECTION_APPROACH = {
+    ('verse', True): "melodic development, moderate complexity, supporting vocal line",
+    ('verse', False): "rhythmic accompaniment, harmonic support, restrained playing",
+    ('chorus', True): "prominent melodic lines, increased energy, memorable hooks",
+    ('chorus', False): "fuller arrangements, stronger rhythmic drive, harmonic richness",
+    ('bridge', True): "contrasting material, unique voicings, creative arrangements",
+    ('bridge', False): "contrasting material, unique voicings, creative arrangements",
+    ('intro', True): "establishing character, building anticipation, thematic introduction",
+    ('intro', False): "establishing character, building anticipation, thematic introduction",
+    ('outro', True): "concluding material, possible solo elements, resolution",
+    ('outro', False): "concluding material, possible solo elements, resolution",
+    ('other', True): "section-appropriate instrumental contribution",
+    ('other', False): "section-appropriate instrumental contribution",
+}
+
+def section_kind_of(section_name_lower):
+    """The first section kind named in a lower-cased section name, or 'other'."""
+    return next((kind for kind in _SECTION_KINDS if kind in section_name_lower), 'other')
+
+# Roles that take chord-progression patterns, and roles whose pitches snap to RAG chord tones
+_BACKING_ROLES = frozenset({'backing', 'supporting'})
+_LEAD_ROLES = frozenset({'lead', 'melody', 'harmony'})
+
+def _clamp_pitch(pitch):
+    """Clamp a scalar pitch to 24-108 with plain comparisons (cheaper than nested max/min)."""
+    return 108 if pitch > 108 else (24 if pitch < 24 else pitch)
+
+def _clamp_velocity(velocity):
+    """Clamp a scalar velocity to the MIDI range 1-127."""
+    return 127 if velocity > 127 else (1 if velocity < 1 else velocity)
 
 def clean_llm_output(text):
-    return re.sub(r"^```[a-zA-Z]*\n?|```$", "", text.strip(), flags=re.MULTILINE).strip()
+    # The fence pattern tolerates indentation itself, so one strip after the sub is enough
+    return _FENCE_RE.sub("", text).strip()
 
 def safe_literal_eval(text):
+    # Count each bracket kind once; more openers than closers means truncated output that
+    # cannot parse as it stands, so auto-close it before the first parse rather than after a failure
+    missing_square = text.count('[') - text.count(']')
+    missing_curly = text.count('{') - text.count('}')
+    if missing_square > 0 or missing_curly > 0:
+        repaired = text + (']' * max(missing_square, 0)) + ('}' * max(missing_curly, 0))
+        try:
+            return _json_loads(repaired)
+        except ValueError:
+            pass
+        try:
+            return ast.literal_eval(repaired)
+        except Exception:
+            pass  # Brackets inside string literals can skew the counts, so still try the raw text
+    # Note lists are plain numeric arrays, which the C JSON decoder handles far faster than the AST
+    try:
+        return _json_loads(text)
+    except ValueError:
+        pass
     try:
         return ast.literal_eval(text)
-    except Exception:
-        if text.count('[') > text.count(']'):
-            text = text + (']' * (text.count('[') - text.count(']')))
-        if text.count('{') > text.count('}'):
-            text = text + ('}' * (text.count('{') - text.count('}')))
+    except Exception as e:
+        logging.error(f"[InstrumentAgent] Failed to parse LLM output after auto-fix: {e}")
+        return []
+
+def decode_notes_output(text):
+    """
+    Decode the note array straight from the first '[' of a response in one scan, falling back
+    to fence stripping and bracket repair when that is not valid JSON.
+    """
+    list_start = text.find('[')
+    if list_start != -1:
+        if orjson is not None:
+            # A clean parse of everything up to the last ']' can only be the same array raw_decode finds
+            try:
+                return orjson.loads(text[list_start:text.rfind(']') + 1])
+            except ValueError:
+                pass
         try:
-            return ast.literal_eval(text)
-        except Exception as e:
-            logging.error(f"[InstrumentAgent] Failed to parse LLM output after auto-fix: {e}")
-            return []
+            return _JSON_DECODER.raw_decode(text, list_start)[0]
+        except ValueError:
+            pass
+    return safe_literal_eval(clean_llm_output(text))
 
-def notes_array_to_dicts(notes_array):
-    return [
-        {'pitch': n[0], 'start': n[1], 'end': n[2], 'velocity': n[3]}
-        for n in notes_array if isinstance(n, (list, tuple)) and len(n) == 4
+# Tracks requested per LLM call; bigger batches mean fewer round trips but less attention per track
+_PROMPT_BATCH_SIZE = 4
+
+_OUTPUT_MARKER_RE = re.compile(r"=== OUTPUT\[(\d+)\] ===")
+
+def build_batched_prompt(tasks):
+    """
+    Combine several per-track prompts into one request, tagging each with its position so the
+    reply can be split back into per-track note arrays.
+    """
+    blocks = [
+        f"=== TRACK[{i}] instrument={instrument} role={role} ===\n{prompt}"
+        for i, (instrument, role, _, _, prompt) in enumerate(tasks)
     ]
+    return (
+        f"You are writing {len(tasks)} instrument tracks for the same piece. "
+        "Each track request below starts with a === TRACK[i] ... === line and has its own instructions.\n"
+        "For every track i, reply with a line === OUTPUT[i] === followed by ONLY that track's JSON array "
+        "of arrays. Output nothing else.\n\n"
+        + "\n\n".join(blocks)
+    )
+
+# How much of the buffer is rescanned per chunk, in case a marker arrives split across chunks
+_MARKER_TAIL = len("=== OUTPUT[999] ===")
+
+def stream_track_notes(prompt, count):
+    """
+    Stream the reply for `count` tracks and decode each track's note array as soon as its
+    section is complete, so parsing overlaps the rest of the generation. A single-track reply is
+    the bare array; batched replies are split on their === OUTPUT[i] === markers. Tracks the
+    reply leaves out, or whose last array was cut off, come back as None.
+    """
+    if count == 1:
+        return [decode_notes_output("".join(cached_gemini_generate_stream(prompt)))]
+    
+    notes = [None] * count
+    buffer = ""
+    section = None  # (track index, offset where its text starts)
+    scan_from = 0
+    for chunk in cached_gemini_generate_stream(prompt):
+        buffer += chunk
+        for marker in _OUTPUT_MARKER_RE.finditer(buffer, scan_from):
+            if section is not None and section[0] < count:
+                notes[section[0]] = decode_notes_output(buffer[section[1]:marker.start()])
+            section = (int(marker.group(1)), marker.end())
+            scan_from = marker.end()
+        scan_from = max(scan_from, len(buffer) - _MARKER_TAIL)
+    
+    if section is not None and section[0] < count:
+        last_text = buffer[section[1]:]
+        # A reply cut off at the output-token limit leaves its last array unclosed; report that
+        # track as missing so it is re-requested on its own instead of kept as a partial part
+        if last_text.count('[') > last_text.count(']'):
+            logging.warning(f"[InstrumentAgent] Batched output for track {section[0]} was truncated")
+        else:
+            notes[section[0]] = decode_notes_output(last_text)
+    return notes
+
+def notes_array_to_soa(notes_array):
+    """Split parsed [pitch, start, end, velocity] rows into four parallel float arrays."""
+    # Well-formed output converts in one C-level call; only malformed rows need the filter
+    try:
+        arr = np.asarray(notes_array, dtype=np.float64)
+    except (TypeError, ValueError):
+        arr = None
+    if arr is None or arr.ndim != 2 or arr.shape[1] != 4:
+        rows = [n for n in notes_array if isinstance(n, (list, tuple)) and len(n) == 4]
+        arr = np.array(rows, dtype=np.float64).reshape(-1, 4)
+    return arr[:, 0], arr[:, 1], arr[:, 2], arr[:, 3]
+
+_INSTRUMENT_MAP = {
+    'piano': 0, 'electric_piano': 4, 'guitar': 24, 
+    'electric_guitar': 30,  # Overdriven Guitar for metal/rock
+    'distortion_guitar': 30, 'overdriven_guitar': 29,
+    'acoustic_guitar': 24, 'bass': 33, 'electric_bass': 34,  # Electric Bass (pick)
+    'violin': 40, 'viola': 41, 'cello': 42, 'trumpet': 56, 
+    'trombone': 57, 'saxophone': 64, 'sax': 64, 'flute': 73, 
+    'clarinet': 71, 'organ': 16, 'synth': 80, 'synthesizer': 80, 
+    'strings': 48, 'pad': 88, 'lead': 80
+}
+
+# Scanned in map order and the first key contained in the name wins
+_INSTRUMENT_ITEMS = tuple(_INSTRUMENT_MAP.items())
 
+# Names the scan would otherwise hand to 'piano' and 'bass', checked first
+_COMPOUND_PROGRAMS = (('electric_piano', 4), ('electric_bass', 34))
+
+@lru_cache(maxsize=256)
 def get_instrument_program(instrument_name):
     """Map instrument names to MIDI program numbers with genre-appropriate sounds."""
-    instrument_map = {
-        'piano': 0, 'electric_piano': 4, 'guitar': 24, 
-        'electric_guitar': 30,  # Overdriven Guitar for metal/rock
-        'distortion_guitar': 30, 'overdriven_guitar': 29,
-        'acoustic_guitar': 24, 'bass': 33, 'electric_bass': 34,  # Electric Bass (pick)
-        'violin': 40, 'viola': 41, 'cello': 42, 'trumpet': 56, 
-        'trombone': 57, 'saxophone': 64, 'sax': 64, 'flute': 73, 
-        'clarinet': 71, 'organ': 16, 'synth': 80, 'synthesizer': 80, 
-        'strings': 48, 'pad': 88, 'lead': 80
-    }
-    
     instrument_lower = instrument_name.lower()
     
     # Enhanced guitar mapping for metal/rock
@@ -53,87 +229,110 @@ def get_instrument_program(instrument_name):
     elif 'guitar' in instrument_lower and any(word in instrument_lower for word in ['metal', 'rock', 'distort']):
         return 30  # Overdriven Guitar
     
-    for key, program in instrument_map.items():
+    for key, program in _COMPOUND_PROGRAMS:
+        if key in instrument_lower:
+            return program
+    
+    for key, program in _INSTRUMENT_ITEMS:
         if key in instrument_lower:
             return program
     return 0  # Default to piano
 
+# Read-only pitch ranges shared by every get_instrument_pitch_range caller
+_GUITAR_HEAVY_RANGE = MappingProxyType({
+    'low': 40,   # E2 (low E string)
+    'high': 75,  # Eb5 (high frets on high E string)
+    'power_chord_range': (28, 55),  # Drop tuning power chords
+    'lead_range': (50, 80),         # Lead guitar range
+    'rhythm_range': (28, 60)        # Rhythm guitar range
+})
+_GUITAR_RANGE = MappingProxyType({'low': 40, 'high': 77})  # Standard guitar range
+_BASS_RANGE = MappingProxyType({
+    'low': 28,   # E1 (4-string bass low E)
+    'high': 50,  # D3 (high fret on G string)
+    'fundamental_range': (28, 43),  # Main bass register
+    'slap_range': (33, 50)          # Slap bass range
+})
+_PIANO_RANGE = MappingProxyType({
+    'low': 21,    # A0 (piano lowest note)
+    'high': 108,  # C8 (piano highest note)
+    'bass_range': (21, 48),      # Left hand/bass
+    'tenor_range': (48, 60),     # Low melody
+    'alto_range': (60, 72),      # Mid melody
+    'soprano_range': (72, 96)    # High melody/lead
+})
+_DRUM_RANGES = MappingProxyType({
+    'kick': (35, 36),
+    'snare': (37, 40),
+    'hihat': (42, 46),
+    'crash': (49, 57),
+    'ride': (51, 59),
+    'toms': (43, 50)
+})
+_TRUMPET_RANGE = MappingProxyType({'low': 58, 'high': 82})     # Bb3 to Bb5
+_SAX_RANGE = MappingProxyType({'low': 49, 'high': 81})         # Db3 to A5 (tenor sax)
+_FLUTE_RANGE = MappingProxyType({'low': 60, 'high': 96})       # C4 to C7
+_VIOLIN_RANGE = MappingProxyType({'low': 55, 'high': 91})      # G3 to G6
+_VIOLA_RANGE = MappingProxyType({'low': 48, 'high': 84})       # C3 to C6
+_CELLO_RANGE = MappingProxyType({'low': 36, 'high': 72})       # C2 to C5
+_SYNTH_BASS_RANGE = MappingProxyType({'low': 24, 'high': 48})  # Bass synth
+_SYNTH_LEAD_RANGE = MappingProxyType({'low': 60, 'high': 96})  # Lead synth
+_SYNTH_RANGE = MappingProxyType({'low': 36, 'high': 84})       # General synth
+_DEFAULT_RANGE = MappingProxyType({'low': 48, 'high': 72})     # C3 to C5
+
+@lru_cache(maxsize=256)
 def get_instrument_pitch_range(instrument_name, genre="pop"):
     """Get appropriate pitch range for each instrument based on its physical capabilities."""
     instrument_lower = instrument_name.lower()
     
-    # Guitar ranges - critical for metal/rock
-    if 'electric_guitar' in instrument_lower or 'guitar' in instrument_lower:
-        if 'metal' in genre.lower() or 'rock' in genre.lower():
-            return {
-                'low': 40,   # E2 (low E string)
-                'high': 75,  # Eb5 (high frets on high E string)
-                'power_chord_range': (28, 55),  # Drop tuning power chords
-                'lead_range': (50, 80),         # Lead guitar range
-                'rhythm_range': (28, 60)        # Rhythm guitar range
-            }
+    # Guitar ranges - critical for metal/rock ('guitar' also covers 'electric_guitar')
+    if 'guitar' in instrument_lower:
+        genre_lower = genre.lower()
+        if 'metal' in genre_lower or 'rock' in genre_lower:
+            return _GUITAR_HEAVY_RANGE
         else:
-            return {'low': 40, 'high': 77}  # Standard guitar range
+            return _GUITAR_RANGE
     
     # Bass guitar - very important for low end
     elif 'bass' in instrument_lower:
-        return {
-            'low': 28,   # E1 (4-string bass low E)
-            'high': 50,  # D3 (high fret on G string)
-            'fundamental_range': (28, 43),  # Main bass register
-            'slap_range': (33, 50)          # Slap bass range
-        }
+        return _BASS_RANGE
     
     # Piano/Keyboard ranges by register
     elif 'piano' in instrument_lower:
-        return {
-            'low': 21,    # A0 (piano lowest note)
-            'high': 108,  # C8 (piano highest note)
-            'bass_range': (21, 48),      # Left hand/bass
-            'tenor_range': (48, 60),     # Low melody
-            'alto_range': (60, 72),      # Mid melody
-            'soprano_range': (72, 96)    # High melody/lead
-        }
+        return _PIANO_RANGE
     
     # Drums - specific MIDI note mappings
     elif 'drum' in instrument_lower:
-        return {
-            'kick': (35, 36),
-            'snare': (37, 40),
-            'hihat': (42, 46),
-            'crash': (49, 57),
-            'ride': (51, 59),
-            'toms': (43, 50)
-        }
+        return _DRUM_RANGES
     
     # Wind instruments
     elif 'trumpet' in instrument_lower:
-        return {'low': 58, 'high': 82}   # Bb3 to Bb5
+        return _TRUMPET_RANGE
     elif 'saxophone' in instrument_lower or 'sax' in instrument_lower:
-        return {'low': 49, 'high': 81}   # Db3 to A5 (tenor sax)
+        return _SAX_RANGE
     elif 'flute' in instrument_lower:
-        return {'low': 60, 'high': 96}   # C4 to C7
+        return _FLUTE_RANGE
     
     # Strings
     elif 'violin' in instrument_lower:
-        return {'low': 55, 'high': 91}   # G3 to G6
+        return _VIOLIN_RANGE
     elif 'viola' in instrument_lower:
-        return {'low': 48, 'high': 84}   # C3 to C6
+        return _VIOLA_RANGE
     elif 'cello' in instrument_lower:
-        return {'low': 36, 'high': 72}   # C2 to C5
+        return _CELLO_RANGE
     
     # Synthesizers - wide range but context dependent
     elif 'synth' in instrument_lower:
         if 'bass' in instrument_lower:
-            return {'low': 24, 'high': 48}   # Bass synth
+            return _SYNTH_BASS_RANGE
         elif 'lead' in instrument_lower:
-            return {'low': 60, 'high': 96}   # Lead synth
+            return _SYNTH_LEAD_RANGE
         else:
-            return {'low': 36, 'high': 84}   # General synth
+            return _SYNTH_RANGE
     
     # Default range for unknown instruments
     else:
-        return {'low': 48, 'high': 72}   # C3 to C5
+        return _DEFAULT_RANGE
 
 def ensure_musical_coherence(notes, instrument, duration_minutes):
     """
@@ -145,7 +344,7 @@ def ensure_musical_coherence(notes, instrument, duration_minutes):
     duration_seconds = duration_minutes * 60
     
     # Check for uneven distribution
-    notes.sort(key=lambda n: n['start'])
+    notes.sort(key=itemgetter('start'))
     
     # Identify gaps longer than 4 seconds (musical silence is OK, but not emptiness)
     large_gaps = []
@@ -188,7 +387,7 @@ def ensure_musical_coherence(notes, instrument, duration_minutes):
     for bucket, bucket_notes in time_buckets.items():
         if len(bucket_notes) > 10:
             # Keep every other note
-            bucket_notes.sort(key=lambda n: n['start'])
+            bucket_notes.sort(key=itemgetter('start'))
             notes_to_remove = bucket_notes[1::2]  # Remove every other note
             for note_to_remove in notes_to_remove:
                 if note_to_remove in notes:
@@ -204,53 +403,61 @@ def validate_musical_flow(notes, instrument, genre, tempo):
         return notes
     
     # Sort by start time
-    notes.sort(key=lambda n: n['start'])
+    notes.sort(key=itemgetter('start'))
     
     # Check for musical problems and fix them
     improved_notes = []
+    instrument_lower = instrument.lower()
+    is_melodic = 'melody' in instrument_lower
+    is_lead_voice = 'lead' in instrument_lower
+    is_sustained = 'pad' in instrument_lower or 'string' in instrument_lower
+    
+    # Tempo-derived limits are the same for every note
+    min_gap = 60 / tempo / 16  # Sixteenth note minimum between notes for clarity
+    beat_duration = 60 / tempo
+    max_duration = beat_duration * 4  # 4 beats max
     
     for i, note in enumerate(notes):
+        pitch, start, end = note['pitch'], note['start'], note['end']
+        
         # Skip notes that are too close together (avoid muddy sound)
         if i > 0:
             prev_note = improved_notes[-1]
-            time_gap = note['start'] - prev_note['start']
+            time_gap = start - prev_note['start']
             
-            # Minimum time between notes for clarity
-            min_gap = 60 / tempo / 16  # Sixteenth note minimum
             if time_gap < min_gap:
                 # Adjust timing slightly
-                note['start'] = prev_note['start'] + min_gap
-                note['end'] = note['start'] + (note['end'] - note['start'])
+                start = prev_note['start'] + min_gap
+                end = start + (end - start)
         
         # Check for extreme interval jumps that sound unmusical
-        if i > 0 and 'melody' in instrument.lower() or 'lead' in instrument.lower():
+        if i > 0 and is_melodic or is_lead_voice:
             prev_pitch = improved_notes[-1]['pitch']
-            interval = abs(note['pitch'] - prev_pitch)
+            interval = abs(pitch - prev_pitch)
             
             # If jump is more than an octave and a half, smooth it out
             if interval > 18:
                 # Find a more melodic intermediate pitch
-                if note['pitch'] > prev_pitch:
+                if pitch > prev_pitch:
                     # Large upward jump - bring it down some
-                    note['pitch'] = prev_pitch + 12  # Octave jump instead
+                    pitch = prev_pitch + 12  # Octave jump instead
                 else:
                     # Large downward jump - bring it up some
-                    note['pitch'] = prev_pitch - 12  # Octave jump instead
+                    pitch = prev_pitch - 12  # Octave jump instead
         
         # Ensure note durations make musical sense
-        beat_duration = 60 / tempo
-        note_duration = note['end'] - note['start']
+        note_duration = end - start
         
         # Very short notes can get lost
         if note_duration < beat_duration / 8:
-            note['end'] = note['start'] + beat_duration / 8
+            end = start + beat_duration / 8
         
         # Very long notes can be boring (except for pads/sustained instruments)
-        max_duration = beat_duration * 4  # 4 beats max
-        if 'pad' not in instrument.lower() and 'string' not in instrument.lower():
+        if not is_sustained:
             if note_duration > max_duration:
-                note['end'] = note['start'] + max_duration
+                end = start + max_duration
         
+        note['pitch'], note['start'], note['end'] = pitch, start, end
         improved_notes.append(note)
     
     return improved_notes
@@ -263,6 +470,7 @@ def add_musical_expression(notes, instrument, genre, role):
         return notes
     
     # Add subtle timing variations (humanization)
+    is_metal = 'metal' in genre.lower()
     for i, note in enumerate(notes):
         # Very subtle timing variations (±10ms)
         import random
@@ -272,9 +480,9 @@ def add_musical_expression(notes, instrument, genre, role):
             note['end'] += timing_variation
         
         # Add velocity variations for more natural feel
-        if 'metal' not in genre.lower():  # Metal should stay aggressive
+        if not is_metal:  # Metal should stay aggressive
             velocity_variation = random.randint(-5, 5)
-            note['velocity'] = max(1, min(127, note['velocity'] + velocity_variation))
+            note['velocity'] = _clamp_velocity(note['velocity'] + velocity_variation)
     
     # Add musical phrasing - group notes into phrases
     if len(notes) > 8:
@@ -295,10 +503,218 @@ def add_musical_expression(notes, instrument, genre, role):
                     # Slight diminuendo from middle
                     volume_factor = 1.05 - ((phrase_progress - 0.5) * 0.1)
                 
-                notes[i]['velocity'] = int(max(1, min(127, notes[i]['velocity'] * volume_factor)))
+                notes[i]['velocity'] = int(_clamp_velocity(notes[i]['velocity'] * volume_factor))
     
     return notes
 
+def _postprocess_notes(pitch, start, end, velocity, min_pitch, max_pitch, vel_lo, vel_hi, tempo):
+    """
+    Numeric note clean-up on parallel arrays: sort, quantize, repair durations, drop wild pitches,
+    octave-correct into range and clamp velocities. Returns the arrays plus rejected/corrected counts.
+    """
+    # Sort (stable, so simultaneous notes keep their order); the gathers give this
+    # function its own arrays, so every later step can work in place
+    order = np.argsort(start, kind='stable')
+    pitch, start, end, velocity = pitch[order], start[order], end[order], velocity[order]
+    
+    # Gentle timing quantization (not too aggressive) on an eighth-note grid
+    beat_grid = 60 / tempo / 8
+    for times in (start, end):
+        np.divide(times, beat_grid, out=times)
+        np.round(times, out=times)
+        np.multiply(times, beat_grid, out=times)
+    
+    # Ensure minimum duration but keep it musical
+    min_duration = 60 / tempo / 4  # Quarter note minimum
+    note_lengths = end - start
+    too_short = note_lengths < min_duration / 4
+    end[too_short] = start[too_short] + min_duration / 4
+    non_positive = note_lengths <= 0
+    end[non_positive] = start[non_positive] + min_duration
+    
+    # Reject notes wildly outside the range (more than 2 octaves) to preserve musicality
+    in_reach = (pitch >= min_pitch - 24) & (pitch <= max_pitch + 24)
+    rejected_count = int(len(pitch) - np.count_nonzero(in_reach))
+    if rejected_count:
+        pitch, start, end, velocity = pitch[in_reach], start[in_reach], end[in_reach], velocity[in_reach]
+    
+    # MUSICAL pitch correction - move out-of-range notes to the nearest octave
+    # of the same pitch class so melody contour is preserved
+    original_pitch = pitch
+    
+    # Closed-form octave shift: the nearest same-class pitch at or above
+    # min_pitch (or at or below max_pitch), no per-note candidate search
+    up_shift = np.ceil((min_pitch - original_pitch) / 12) * 12
+    down_shift = np.ceil((original_pitch - max_pitch) / 12) * 12
+    pitch = np.where(original_pitch < min_pitch, original_pitch + up_shift,
+                     np.where(original_pitch > max_pitch, original_pitch - down_shift, original_pitch))
+    
+    # Final safety clamp (but this should rarely be needed now)
+    np.clip(pitch, min_pitch, max_pitch, out=pitch)
+    corrected_count = int(np.count_nonzero(pitch != original_pitch))
+    
+    np.clip(velocity, vel_lo, vel_hi, out=velocity)
+    return pitch, start, end, velocity, rejected_count, corrected_count
+
+def _build_track(notes_array, instrument, role, is_lead, pitch_range, genre, tempo, duration, rag_patterns,
+                 transpose=0):
+    """
+    Turn one instrument's parsed LLM note array into a finished track: range-correct,
+    smooth, humanize and apply RAG patterns. `transpose` shifts the parsed pitches first,
+    for a track that doubles another instrument's part.
+    """
+    instrument_lower = instrument.lower()
+    genre_lower = genre.lower()
+    
+    pitch, start, end, velocity = notes_array_to_soa(notes_array)
+    if transpose:
+        pitch = pitch + transpose
+    
+    # Post-process notes with strict pitch range enforcement
+    if len(pitch):
+        note_count = len(pitch)
+        
+        # Validate against the prompt's pitch range with more flexible boundaries
+        min_pitch = pitch_range.get('low', 21)
+        max_pitch = pitch_range.get('high', 108)
+        
+        # Apply more musical range settings that preserve musical character
+        if 'guitar' in instrument_lower and ('metal' in genre_lower or 'rock' in genre_lower):
+            if is_lead:
+                # Allow wider range for lead guitar solos
+                min_pitch = max(28, pitch_range.get('lead_range', (50, 80))[0] - 12)  # Extended low
+                max_pitch = min(108, pitch_range.get('lead_range', (50, 80))[1] + 12)  # Extended high
+            else:
+                # Rhythm guitar - focus on power chord range but allow some flexibility
+                min_pitch = pitch_range.get('rhythm_range', (28, 60))[0]
+                max_pitch = pitch_range.get('rhythm_range', (28, 60))[1] + 12  # Allow higher notes
+        elif 'bass' in instrument_lower:
+            # Bass needs strict low-end but can have some melodic range
+            min_pitch = pitch_range.get('fundamental_range', (28, 43))[0]
+            max_pitch = pitch_range.get('fundamental_range', (28, 43))[1] + 12  # Allow bass melodies
+        elif 'piano' in instrument_lower:
+            if is_lead:
+                # Piano lead - wide range but prefer upper register
+                min_pitch = pitch_range.get('alto_range', (60, 72))[0] - 12  # Allow some bass notes
+                max_pitch = pitch_range.get('soprano_range', (72, 96))[1]
+            else:
+                # Piano accompaniment - full range but smart distribution
+                min_pitch = pitch_range.get('bass_range', (21, 48))[0]
+                max_pitch = pitch_range.get('alto_range', (60, 72))[1] + 12  # Allow some treble
+        else:
+            # Other instruments - use natural range with some flexibility
+            range_span = max_pitch - min_pitch
+            extension = min(12, range_span // 4)  # Extend by up to an octave or 25% of range
+            min_pitch = max(21, min_pitch - extension)
+            max_pitch = min(108, max_pitch + extension)
+        
+        # MUSICAL velocity adjustment - preserve dynamics while ensuring audibility
+        if 'metal' in genre_lower and 'guitar' in instrument_lower:
+            # Ensure minimum aggression but allow dynamic range
+            velocity_range = (95, 127)
+        elif 'bass' in instrument_lower and 'metal' in genre_lower:
+            # Strong bass but not overpowering
+            velocity_range = (85, 120)
+        elif 'jazz' in genre_lower:
+            # Jazz needs subtle dynamics
+            velocity_range = (50, 100)
+        elif 'classical' in genre_lower:
+            # Classical needs wide dynamic range
+            velocity_range = (40, 110)
+        elif is_lead:
+            # Lead instruments need prominence but not harshness
+            velocity_range = (75, 115)
+        else:
+            # Backing instruments support without overpowering
+            velocity_range = (65, 105)
+        
+        pitch, start, end, velocity, rejected_count, corrected_count = _postprocess_notes(
+            pitch, start, end, velocity, min_pitch, max_pitch, velocity_range[0], velocity_range[1], tempo)
+        
+        if corrected_count > 0:
+            logging.info(f"[InstrumentAgent] Musically corrected {corrected_count}/{note_count} pitches for {instrument} (range: {min_pitch}-{max_pitch})")
+        
+        if rejected_count > 0:
+            logging.info(f"[InstrumentAgent] Rejected {rejected_count} extremely out-of-range notes for {instrument} to preserve musicality")
+        
+        # Back to note dicts at the boundary: downstream helpers and the MIDI writer consume them
+        # (np.rint rounds half to even, like round())
+        notes = [
+            {'pitch': p, 'start': s, 'end': e, 'velocity': v}
+            for p, s, e, v in zip(np.rint(pitch).astype(np.int64).tolist(), start.tolist(), end.tolist(),
+                                  np.rint(velocity).astype(np.int64).tolist())
+        ]
+        
+        # Apply musical validation and smoothing
+        if notes:
+            # Apply musical validation and smoothing
+            notes = validate_musical_flow(notes, instrument, genre, tempo)
+            
+            # Ensure musical coherence across the track
+            notes = ensure_musical_coherence(notes, instrument, duration)
+            
+            # Add musical expression to avoid robotic sound
+            notes = add_musical_expression(notes, instrument, genre, role)
+        
+        # Pack the finished notes into one structured array: the coverage check reads its end
+        # column and the RAG pass transforms it, instead of each walking the dicts
+        record = _notes_to_record(notes, True)
+        
+        # Check coverage
+        max_end = record['end'].max()
+        coverage_ratio = max_end / (duration * 60)
+        
+        logging.info(f"[InstrumentAgent] {instrument} ({role}): {len(notes)} notes, "
+                    f"{coverage_ratio:.1%} coverage")
+        
+        # APPLY REAL MIDI PATTERNS to enhance the generated notes
+        if rag_patterns:
+            notes = apply_rag_patterns_to_notes(notes, rag_patterns, instrument, role, duration, record=record)
+    else:
+        logging.warning(f"[InstrumentAgent] No notes generated for {instrument}")
+        notes = []
+    
+    # Create track
+    track = {
+        'name': f"{instrument.title()} ({role.title()})",
+        'program': get_instrument_program(instrument),
+        'is_drum': False,
+        'notes': notes,
+        'instrument': instrument,
+        'role': role
+    }
+    
+    return track
+
+def _fallback_track(instrument, role, pitch_range, key_signature, duration):
+    """
+    A part that needs no LLM call: the tonic chord of the key (just the root for basses),
+    sustained for the whole piece in the middle of the instrument's range.
+    """
+    key_parts = key_signature.split()
+    tonic = NOTE_NAME_TO_MIDI.get(key_parts[0].capitalize() if key_parts else 'C', 0)
+    is_minor = 'minor' in key_signature.lower()
+    
+    low, high = pitch_range['low'], pitch_range['high']
+    center = (low + high) // 2
+    root = center - (center - tonic) % 12
+    intervals = (0,) if 'bass' in instrument.lower() else (0, 3 if is_minor else 4, 7)
+    
+    end = duration * 60.0
+    notes = [
+        {'pitch': root + interval, 'start': 0.0, 'end': end, 'velocity': 64}
+        for interval in intervals if low <= root + interval <= high
+    ]
+    
+    return {
+        'name': f"{instrument.title()} ({role.title()})",
+        'program': get_instrument_program(instrument),
+        'is_drum': False,
+        'notes': notes,
+        'instrument': instrument,
+        'role': role
+    }
+
 def instrument_agent(state: Any) -> Any:
     """
     Generate sophisticated multi-instrument arrangements with style-specific playing techniques.
@@ -320,11 +736,15 @@ def instrument_agent(state: Any) -> Any:
         artist_instrument_instructions = state.get('artist_instrument_instructions', {})
         pattern_summary = state.get('pattern_summary', '')
         
+        # Retrieved patterns are read-only for this agent; fetch them once
+        rag_patterns = state.get('rag_patterns', {})
+        
         # Basic parameters
         genre = musical_context.get('full_genre', state.get('genre', 'pop'))
         mood = musical_context.get('full_mood', state.get('mood', 'happy'))
         tempo = state.get('tempo', 120)
         duration = state.get('duration', 2)
+        genre_lower = genre.lower()
         
         # Instrumentation
         instruments = state.get('instruments', ['piano'])
@@ -332,101 +752,146 @@ def instrument_agent(state: Any) -> Any:
         backing_instruments = state.get('backing_instruments', [])
         instrument_description = state.get('instrument_description', '')
         
-        # Get artist patterns if available
-        artist_patterns = state.get('artist_patterns', {})
-        artist_instructions = state.get('artist_instrument_instructions', {})
-        
         # Artist-specific arrangement characteristics
         arrangement_style = artist_profile.get('arrangement_style', 'balanced arrangement with clear instrument roles')
         instrumentation_style = artist_profile.get('instrumentation_style', 'genre-appropriate instrumentation choices')
         style_summary = artist_profile.get('style_summary', '')
         
-        # Combine all instruments
-        all_instruments = list(set(instruments + backing_instruments))
-        if lead_instrument and lead_instrument not in all_instruments:
-            all_instruments.append(lead_instrument)
+        # Combine all instruments, deduplicated in request order so role assignment is stable.
+        # Drums are handled by the drum agent, so they are dropped here.
+        all_instruments = [
+            inst for inst in dict.fromkeys([*instruments, *backing_instruments, lead_instrument])
+            if inst and inst.lower() not in _DRUM_NAMES
+        ]
         
         if not all_instruments:
             logging.warning("[InstrumentAgent] No instruments specified, skipping.")
             return safe_state_update(state, {'instrument_tracks': {'instrument_tracks': []}}, "InstrumentAgent")
         
-        # Create individual tracks for each instrument
+        # With no melody timing and no sections there is nothing to coordinate with, and the
+        # LLM tends to return empty arrays; skip the prompts and calls and sustain the tonic instead
+        if not melody_onsets and not bar_times and not structured_sections:
+            logging.warning("[InstrumentAgent] No melody timing or song sections available, using sustained fallback parts.")
+            key_signature = state.get('key_signature', 'C major')
+            fallback_tracks = []
+            for i, instrument in enumerate(all_instruments):
+                is_lead = instrument == lead_instrument or (not lead_instrument and i == 0)
+                role = "lead" if is_lead else "backing" if instrument in backing_instruments else "supporting"
+                fallback_tracks.append(_fallback_track(instrument, role, get_instrument_pitch_range(instrument, genre),
+                                                       key_signature, duration))
+            return safe_state_update(state, {'instrument_tracks': {'instrument_tracks': fallback_tracks}}, "InstrumentAgent")
+        
+        # Section-specific instructions only depend on whether the part leads, so walk the sections once
+        section_instructions_by_role = dict.fromkeys(("lead", "backing", "supporting"), "")
+        if structured_sections and len(structured_sections) > 2:
+            section_lines_lead = []
+            section_lines_backing = []
+            for section in structured_sections:
+                section_kind = section_kind_of(section['name'].lower())
+                section_prefix = f"- {section['name'].upper()} ({section['start_time']:.1f}s-{section['end_time']:.1f}s): "
+                section_lines_lead.append(section_prefix + _SECTION_APPROACH[(section_kind, True)] + "\n")
+                section_lines_backing.append(section_prefix + _SECTION_APPROACH[(section_kind, False)] + "\n")
+            section_body_lead = "".join(section_lines_lead)
+            section_body_backing = "".join(section_lines_backing)
+            for role in section_instructions_by_role:
+                section_body = section_body_lead if role == "lead" else section_body_backing
+                section_instructions_by_role[role] = f"\nCREATE {role.upper()} PARTS FOR EACH SECTION:\n" + section_body
+        
+        # Timing strings shared by every instrument prompt
+        melody_sync = str(melody_onsets[:15])
+        melody_phrase_starts = str(melody_onsets[:10])
+        bar_str = str(np.char.mod("%.2fs", np.asarray(bar_times[:8], dtype=np.float64)).tolist())
+        beat_grid_str = str(np.char.mod("%.2f", np.arange(int(duration*tempo/60)) * 60 / tempo).tolist())
+        bar_len = 60 / tempo * 4
+        beat = 60 / tempo
+        quarter = 60 / tempo / 4
+        
+        # Prompt pieces that are the same for every instrument
+        genre_upper = genre.upper()
+        is_metal_or_rock = 'metal' in genre_lower or 'rock' in genre_lower
+        is_jazz = 'jazz' in genre_lower
+        is_blues = 'blues' in genre_lower
+        is_classical = 'classical' in genre_lower
+        is_funk = 'funk' in genre_lower
+        shared_context = f"""ARRANGEMENT CONTEXT: {arrangement_style}
+            INSTRUMENTATION STYLE: {instrumentation_style}
+            {f'ARTIST CONTEXT: {style_summary}' if style_summary else ''}
+            {f'PERFORMANCE INSTRUCTIONS: {instrument_description}' if instrument_description else ''}
+            
+            MUSICAL PARAMETERS:
+            - Tempo: {tempo} BPM
+            - Duration: {duration} minutes  
+            - Key Context: Available from chord progression
+            - Time Signature: {structure.get('time_signature', '4/4')}
+            """
+        
+        rag_instruction_cache = {}
+        
+        # Build every instrument prompt first, then generate the tracks. track_plan lists every
+        # track in request order with the generation task that supplies its notes.
+        backing_set = frozenset(backing_instruments)
+        generation_tasks = []
+        track_plan = []
+        shared_part_sources = {}
         instrument_tracks = []
         
         for i, instrument in enumerate(all_instruments):
-            if instrument.lower() in ['drums', 'percussion']:
-                continue  # Skip drums - handled by drum agent
+            instrument_lower = instrument.lower()
             
             # Determine instrument role
             is_lead = (instrument == lead_instrument or 
                       (not lead_instrument and i == 0))
-            is_backing = instrument in backing_instruments
+            is_backing = instrument in backing_set
             
             role = "lead" if is_lead else "backing" if is_backing else "supporting"
+            role_upper = role.upper()
+            instrument_upper = instrument.upper()
             
-            # Section-specific instructions
-            section_instructions = ""
-            if structured_sections and len(structured_sections) > 2:
-                section_instructions = f"\nCREATE {role.upper()} PARTS FOR EACH SECTION:\n"
-                for section in structured_sections:
-                    section_start = section['start_time']
-                    section_end = section['end_time']
-                    section_name = section['name'].upper()
-                    
-                    if 'verse' in section['name'].lower():
-                        if is_lead:
-                            approach = "melodic development, moderate complexity, supporting vocal line"
-                        else:
-                            approach = "rhythmic accompaniment, harmonic support, restrained playing"
-                    elif 'chorus' in section['name'].lower():
-                        if is_lead:
-                            approach = "prominent melodic lines, increased energy, memorable hooks"
-                        else:
-                            approach = "fuller arrangements, stronger rhythmic drive, harmonic richness"
-                    elif 'bridge' in section['name'].lower():
-                        approach = "contrasting material, unique voicings, creative arrangements"
-                    elif 'intro' in section['name'].lower():
-                        approach = "establishing character, building anticipation, thematic introduction"
-                    elif 'outro' in section['name'].lower():
-                        approach = "concluding material, possible solo elements, resolution"
-                    else:
-                        approach = "section-appropriate instrumental contribution"
-                    
-                    section_instructions += f"- {section_name} ({section_start:.1f}s-{section_end:.1f}s): {approach}\n"
+            # Instrument pitch ranges, shared by the prompt and note validation
+            pitch_range = get_instrument_pitch_range(instrument, genre)
+            
+            section_instructions = section_instructions_by_role[role]
             
             # Build instrument-specific prompt with REAL MIDI PATTERNS
             context_description = f"""
             Create {instrument} parts for {genre} with {mood} character.
             
-            INSTRUMENT ROLE: {role.upper()}
-            ARRANGEMENT CONTEXT: {arrangement_style}
-            INSTRUMENTATION STYLE: {instrumentation_style}
-            {f'ARTIST CONTEXT: {style_summary}' if style_summary else ''}
-            {f'PERFORMANCE INSTRUCTIONS: {instrument_description}' if instrument_description else ''}
-            
-            MUSICAL PARAMETERS:
-            - Tempo: {tempo} BPM
-            - Duration: {duration} minutes  
-            - Key Context: Available from chord progression
-            - Time Signature: {structure.get('time_signature', '4/4')}
-            """
+            INSTRUMENT ROLE: {role_upper}
+            {shared_context}"""
             
             # Get RAG-specific patterns for this instrument
-            rag_patterns_instruction = get_rag_patterns_for_instrument(state, instrument, role)
+            # The RAG text only depends on the lower-cased name and role, so reuse it when repeated
+            rag_key = (instrument_lower, role)
+            rag_patterns_instruction = rag_instruction_cache.get(rag_key)
+            if rag_patterns_instruction is None:
+                rag_patterns_instruction = get_rag_patterns_for_instrument(state, instrument, role)
+                rag_instruction_cache[rag_key] = rag_patterns_instruction
             context_description += f"\n\nRAG RETRIEVED PATTERNS:\n{rag_patterns_instruction}"
             
-            # Get instrument pitch ranges
-            pitch_range = get_instrument_pitch_range(instrument, genre)
+            family = instrument_family(instrument_lower)
+            
+            # Genre, mood, tempo, duration and the song structure are the same for every prompt in
+            # this call, so instruments of one orchestral section (violin/viola/cello, ...) in the
+            # same role only differ in name and range; only the first is requested, later ones
+            # double its part, shifted by whole octaves towards their own range
+            section_family = doubling_family(instrument_lower) if family == 'other' else None
+            if section_family is not None:
+                shared_key = (role, section_family)
+                source = shared_part_sources.get(shared_key)
+                if source is not None:
+                    source_task, source_range = source
+                    octave_shift = 12 * round(((pitch_range['low'] + pitch_range['high']) -
+                                               (source_range['low'] + source_range['high'])) / 24)
+                    logging.info(f"[InstrumentAgent] {instrument} doubles the {generation_tasks[source_task][0]} part ({octave_shift:+d} semitones)")
+                    track_plan.append((instrument, role, is_lead, pitch_range, source_task, octave_shift))
+                    continue
+                shared_part_sources[shared_key] = (len(generation_tasks), pitch_range)
             
             # Instrument-specific playing techniques enhanced by genre
             technique_guidance = ""
-            instrument_lower = instrument.lower()
             
-            if 'guitar' in instrument_lower:
-                if 'metal' in genre.lower() or 'rock' in genre.lower():
-                    # Get RAG patterns for reference
-                    rag_patterns = state.get('rag_patterns', {})
-                    
+            if family == 'guitar':
+                if is_metal_or_rock:
                     if is_lead:
                         technique_guidance = f"""ELECTRIC GUITAR LEAD - METAL/ROCK SPECIFICATIONS:
                         
@@ -481,10 +946,10 @@ def instrument_agent(state: Any) -> Any:
                         
                         Velocity: 85-115, Duration: 0.2-1.5s for rhythm parts
                         """
-                elif 'jazz' in genre.lower():
+                elif is_jazz:
                     technique_guidance = f"""JAZZ GUITAR: Sophisticated chord voicings {pitch_range['low']}-{pitch_range['high']}, 
                     extended chords, chromatic approach tones, swing feel. Velocity 65-85."""
-                elif 'blues' in genre.lower():
+                elif is_blues:
                     technique_guidance = f"""BLUES GUITAR: Blue notes, string bending, slide techniques {pitch_range['low']}-{pitch_range['high']}. 
                     Pentatonic scales, call-and-response phrasing. Velocity 70-95."""
                 else:  # Pop/other
@@ -495,17 +960,17 @@ def instrument_agent(state: Any) -> Any:
                         technique_guidance = f"""POP GUITAR RHYTHM: Chord strumming, arpeggios {pitch_range['low']}-{pitch_range['high']}. 
                         Velocity 70-90."""
                         
-            elif 'piano' in instrument_lower:
+            elif family == 'piano':
                 bass_range = pitch_range.get('bass_range', (21, 48))
                 melody_range = pitch_range.get('soprano_range', (72, 96)) if is_lead else pitch_range.get('alto_range', (60, 72))
                 
-                if 'jazz' in genre.lower():
+                if is_jazz:
                     technique_guidance = f"""JAZZ PIANO: Sophisticated voicings, walking bass lines in left hand {bass_range[0]}-{bass_range[1]}, 
                     bebop lines in right hand {melody_range[0]}-{melody_range[1]}. Block chords and comping. Velocity 60-90."""
-                elif 'classical' in genre.lower():
+                elif is_classical:
                     technique_guidance = f"""CLASSICAL PIANO: Proper voice leading {pitch_range['low']}-{pitch_range['high']}, 
                     balanced hands, pedaling effects. Velocity 50-100."""
-                elif 'blues' in genre.lower():
+                elif is_blues:
                     technique_guidance = f"""BLUES PIANO: Blues scales, boogie-woogie left hand {bass_range[0]}-{bass_range[1]}, 
                     blues chord progressions. Grace notes and blue notes. Velocity 70-100."""
                 else:  # Pop/rock
@@ -516,18 +981,18 @@ def instrument_agent(state: Any) -> Any:
                         technique_guidance = f"""PIANO ACCOMPANIMENT: Chord voicings {bass_range[0]}-{melody_range[1]}, 
                         bass lines in left hand. Velocity 65-85."""
                         
-            elif 'bass' in instrument_lower:
+            elif family == 'bass':
                 fundamental_range = pitch_range.get('fundamental_range', (28, 43))
                 
-                if 'metal' in genre.lower() or 'rock' in genre.lower():
+                if is_metal_or_rock:
                     technique_guidance = f"""METAL BASS: Powerful, driving bass lines {pitch_range['low']}-{pitch_range['high']} 
                     following guitar riffs. Aggressive attack, low-end emphasis. Include fast passages and chromatic runs. 
                     Focus on fundamental range {fundamental_range[0]}-{fundamental_range[1]}. 
                     Velocity 85-115 for metal power. Use short, punchy notes (0.2-0.8s) for palm-muted sections."""
-                elif 'jazz' in genre.lower():
+                elif is_jazz:
                     technique_guidance = f"""JAZZ BASS: Walking bass lines {pitch_range['low']}-{pitch_range['high']} 
                     with sophisticated harmonic movement. Include passing tones. Velocity 65-85."""
-                elif 'funk' in genre.lower():
+                elif is_funk:
                     technique_guidance = f"""FUNK BASS: Syncopated, rhythmically complex patterns {pitch_range['low']}-{pitch_range['high']} 
                     with ghost notes. Slapping and popping techniques. Velocity 70-100."""
                 else:  # Pop/other
@@ -543,24 +1008,24 @@ def instrument_agent(state: Any) -> Any:
             
             {section_instructions}
             
-            INSTRUMENT: {instrument.upper()} - {role.upper()} ROLE
-            GENRE: {genre.upper()}
+            INSTRUMENT: {instrument_upper} - {role_upper} ROLE
+            GENRE: {genre_upper}
             
             {technique_guidance}
             
             TIMING COORDINATION (CRITICAL FOR SYNC):
-            - Melody onset times (sync points): {melody_onsets[:15]}...
-            - Bar boundaries every {60/tempo*4:.2f}s: {[f"{t:.2f}s" for t in bar_times[:8]]}...
-            - Beat grid (align all notes): {[f"{i*60/tempo:.2f}" for i in range(int(duration*tempo/60))]}...
+            - Melody onset times (sync points): {melody_sync}...
+            - Bar boundaries every {bar_len:.2f}s: {bar_str}...
+            - Beat grid (align all notes): {beat_grid_str}...
             
             SYNCHRONIZATION REQUIREMENTS:
-            1. START major musical phrases at melody onset times: {melody_onsets[:10]}
-            2. ALIGN all note start times to quarter-beat grid (multiples of {60/tempo/4:.3f}s)
-            3. COORDINATE with tempo {tempo} BPM - each beat = {60/tempo:.3f}s
+            1. START major musical phrases at melody onset times: {melody_phrase_starts}
+            2. ALIGN all note start times to quarter-beat grid (multiples of {quarter:.3f}s)
+            3. COORDINATE with tempo {tempo} BPM - each beat = {beat:.3f}s
             4. MATCH the energy and dynamics of the melody structure
             5. CREATE complementary parts that ENHANCE the melody, don't compete
             
-            CRITICAL REQUIREMENTS FOR {instrument.upper()} IN {genre.upper()}:
+            CRITICAL REQUIREMENTS FOR {instrument_upper} IN {genre_upper}:
             1. Generate {instrument} parts for FULL {duration} minutes ({duration * 60} seconds)
             2. ABSOLUTELY MANDATORY: Use ONLY pitches within the specified ranges - any note outside will be rejected
             3. Use the exact velocity ranges specified for {genre} character - this creates the genre sound
@@ -570,7 +1035,7 @@ def instrument_agent(state: Any) -> Any:
             7. Create GENRE-APPROPRIATE sound - {genre} should sound distinctly different from other genres
             8. For METAL/ROCK: Make it sound AGGRESSIVE and POWERFUL with proper guitar techniques
             9. CREATE VARIATION: Do NOT repeat the same patterns - build musical development
-            10. SYNC to beat grid: Align notes to multiples of {60/tempo/4:.3f}s for timing sync
+            10. SYNC to beat grid: Align notes to multiples of {quarter:.3f}s for timing sync
             
             ANTI-REPETITION REQUIREMENTS:
             - Use at least 3-4 different riff/phrase patterns throughout the song
@@ -587,7 +1052,7 @@ def instrument_agent(state: Any) -> Any:
             - Each instrument MUST stay in its designated register to avoid muddy mixing
             
             OUTPUT FORMAT:
-            Generate ONLY a valid Python list of lists: [[pitch, start_time, end_time, velocity], ...]
+            Generate ONLY a valid JSON array of arrays: [[pitch, start_time, end_time, velocity], ...]
             
             PITCH VALUES: MIDI numbers WITHIN THE SPECIFIED RANGES ABOVE
             TIME VALUES: Precise seconds aligned to musical structure  
@@ -597,195 +1062,50 @@ def instrument_agent(state: Any) -> Any:
             EXAMPLE FOR METAL ELECTRIC GUITAR:
             [[40, 0.0, 0.3, 110], [45, 0.3, 0.6, 115], [40, 0.6, 0.9, 110]] # Power chord riff
             
-            NO explanations, NO text, ONLY the list.
+            NO explanations, NO text, NO comments, ONLY the JSON array.
             """
             
-            logging.info(f"[InstrumentAgent] Generating {role} {instrument} track...")
-            
-            try:
-                instrument_text = gemini_generate(final_prompt)
-                cleaned = clean_llm_output(instrument_text)
-                notes_array = safe_literal_eval(cleaned)
-                notes = notes_array_to_dicts(notes_array)
+            track_plan.append((instrument, role, is_lead, pitch_range, len(generation_tasks), 0))
+            generation_tasks.append((instrument, role, is_lead, pitch_range, final_prompt))
+        
+        # Several tracks share one streamed LLM request; the batches are network-bound and independent,
+        # so overlap them, and re-request a track the moment its batch comes back without it
+        batches = [range(i, min(i + _PROMPT_BATCH_SIZE, len(generation_tasks)))
+                   for i in range(0, len(generation_tasks), _PROMPT_BATCH_SIZE)]
+        task_outputs = [None] * len(generation_tasks)
+        retry_futures = {}
+        if generation_tasks:
+            with ThreadPoolExecutor(max_workers=min(8, len(generation_tasks))) as executor:
+                batch_futures = {}
+                for batch in batches:
+                    batch_tasks = [generation_tasks[t] for t in batch]
+                    for instrument, role, _, _, _ in batch_tasks:
+                        logging.info(f"[InstrumentAgent] Generating {role} {instrument} track...")
+                    batch_prompt = batch_tasks[0][4] if len(batch_tasks) == 1 else build_batched_prompt(batch_tasks)
+                    batch_futures[executor.submit(stream_track_notes, batch_prompt, len(batch))] = batch
                 
-                # Post-process notes with strict pitch range enforcement
-                if notes:
-                    # Sort and validate
-                    notes.sort(key=lambda n: n['start'])
-                    
-                    # Get pitch range for validation with more flexible boundaries
-                    pitch_range = get_instrument_pitch_range(instrument, genre)
-                    min_pitch = pitch_range.get('low', 21)
-                    max_pitch = pitch_range.get('high', 108)
+                for future in as_completed(batch_futures):
+                    batch = batch_futures[future]
+                    try:
+                        outputs = future.result()
+                    except Exception as e:
+                        logging.error(f"[InstrumentAgent] Batched generation failed, retrying tracks one by one: {e}")
+                        outputs = [None] * len(batch)
                     
-                    # Apply more musical range settings that preserve musical character
-                    if 'guitar' in instrument.lower() and ('metal' in genre.lower() or 'rock' in genre.lower()):
-                        if is_lead:
-                            # Allow wider range for lead guitar solos
-                            min_pitch = max(28, pitch_range.get('lead_range', (50, 80))[0] - 12)  # Extended low
-                            max_pitch = min(108, pitch_range.get('lead_range', (50, 80))[1] + 12)  # Extended high
-                        else:
-                            # Rhythm guitar - focus on power chord range but allow some flexibility
-                            min_pitch = pitch_range.get('rhythm_range', (28, 60))[0]
-                            max_pitch = pitch_range.get('rhythm_range', (28, 60))[1] + 12  # Allow higher notes
-                    elif 'bass' in instrument.lower():
-                        # Bass needs strict low-end but can have some melodic range
-                        min_pitch = pitch_range.get('fundamental_range', (28, 43))[0]
-                        max_pitch = pitch_range.get('fundamental_range', (28, 43))[1] + 12  # Allow bass melodies
-                    elif 'piano' in instrument.lower():
-                        if is_lead:
-                            # Piano lead - wide range but prefer upper register
-                            min_pitch = pitch_range.get('alto_range', (60, 72))[0] - 12  # Allow some bass notes
-                            max_pitch = pitch_range.get('soprano_range', (72, 96))[1]
+                    for t, output in zip(batch, outputs):
+                        if output is None:
+                            # Missing from the batched reply; ask for this track on its own
+                            logging.warning(f"[InstrumentAgent] No batched output for {generation_tasks[t][0]}, generating it alone")
+                            retry_futures[t] = executor.submit(stream_track_notes, generation_tasks[t][4], 1)
                         else:
-                            # Piano accompaniment - full range but smart distribution
-                            min_pitch = pitch_range.get('bass_range', (21, 48))[0]
-                            max_pitch = pitch_range.get('alto_range', (60, 72))[1] + 12  # Allow some treble
-                    else:
-                        # Other instruments - use natural range with some flexibility
-                        range_span = max_pitch - min_pitch
-                        extension = min(12, range_span // 4)  # Extend by up to an octave or 25% of range
-                        min_pitch = max(21, min_pitch - extension)
-                        max_pitch = min(108, max_pitch + extension)
-                    
-                    valid_notes = []
-                    corrected_count = 0
-                    rejected_count = 0
-                    
-                    for note in notes:
-                        # Gentle timing quantization (not too aggressive)
-                        beat_grid = 60 / tempo / 8  # Eighth-note grid for more natural timing
-                        note['start'] = round(note['start'] / beat_grid) * beat_grid
-                        note['end'] = round(note['end'] / beat_grid) * beat_grid
-                        
-                        # Ensure minimum duration but keep it musical
-                        min_duration = 60 / tempo / 4  # Quarter note minimum
-                        if note['end'] <= note['start']:
-                            note['end'] = note['start'] + min_duration
-                        elif (note['end'] - note['start']) < min_duration / 4:
-                            note['end'] = note['start'] + min_duration / 4  # Allow very short notes
-                        
-                        # INTELLIGENT pitch range enforcement - preserve musical intervals
-                        original_pitch = note['pitch']
-                        
-                        # Check if note is wildly outside range (more than 2 octaves)
-                        if note['pitch'] < min_pitch - 24 or note['pitch'] > max_pitch + 24:
-                            # Reject extremely out-of-range notes to preserve musicality
-                            rejected_count += 1
-                            logging.debug(f"[InstrumentAgent] Rejected wildly out-of-range note: {original_pitch} for {instrument}")
-                            continue
-                        
-                        # MUSICAL pitch correction - preserve intervals and melody contour
-                        if note['pitch'] < min_pitch:
-                            # Try to find the best octave that preserves the musical character
-                            pitch_class = original_pitch % 12
-                            target_octave = (min_pitch // 12)
-                            
-                            # Try current octave and one above
-                            candidate1 = target_octave * 12 + pitch_class
-                            candidate2 = (target_octave + 1) * 12 + pitch_class
-                            
-                            # Choose the candidate closest to original pitch
-                            if abs(candidate1 - original_pitch) <= abs(candidate2 - original_pitch):
-                                note['pitch'] = candidate1 if candidate1 >= min_pitch else candidate2
-                            else:
-                                note['pitch'] = candidate2 if candidate2 <= max_pitch else candidate1
-                                
-                        elif note['pitch'] > max_pitch:
-                            # Try to find the best octave that preserves the musical character
-                            pitch_class = original_pitch % 12
-                            target_octave = (max_pitch // 12)
-                            
-                            # Try current octave and one below
-                            candidate1 = target_octave * 12 + pitch_class
-                            candidate2 = (target_octave - 1) * 12 + pitch_class
-                            
-                            # Choose the candidate closest to original pitch
-                            if abs(candidate1 - original_pitch) <= abs(candidate2 - original_pitch):
-                                note['pitch'] = candidate1 if candidate1 <= max_pitch else candidate2
-                            else:
-                                note['pitch'] = candidate2 if candidate2 >= min_pitch else candidate1
-                        
-                        # Final safety clamp (but this should rarely be needed now)
-                        note['pitch'] = max(min_pitch, min(max_pitch, note['pitch']))
-                        
-                        if original_pitch != note['pitch']:
-                            corrected_count += 1
-                            logging.debug(f"[InstrumentAgent] Musically corrected pitch {original_pitch} → {note['pitch']} for {instrument}")
-                        
-                        # MUSICAL velocity adjustment - preserve dynamics while ensuring audibility
-                        original_velocity = note['velocity']
-                        
-                        if 'metal' in genre.lower() and 'guitar' in instrument.lower():
-                            # Ensure minimum aggression but allow dynamic range
-                            note['velocity'] = max(95, min(127, note['velocity']))
-                        elif 'bass' in instrument.lower() and 'metal' in genre.lower():
-                            # Strong bass but not overpowering
-                            note['velocity'] = max(85, min(120, note['velocity']))
-                        elif 'jazz' in genre.lower():
-                            # Jazz needs subtle dynamics
-                            note['velocity'] = max(50, min(100, note['velocity']))
-                        elif 'classical' in genre.lower():
-                            # Classical needs wide dynamic range
-                            note['velocity'] = max(40, min(110, note['velocity']))
-                        elif is_lead:
-                            # Lead instruments need prominence but not harshness
-                            note['velocity'] = max(75, min(115, note['velocity']))
-                        else:
-                            # Backing instruments support without overpowering
-                            note['velocity'] = max(65, min(105, note['velocity']))
-                        
-                        # Ensure velocity is valid MIDI range
-                        note['velocity'] = max(1, min(127, note['velocity']))
-                        
-                        valid_notes.append(note)
-                    
-                    if corrected_count > 0:
-                        logging.info(f"[InstrumentAgent] Musically corrected {corrected_count}/{len(notes)} pitches for {instrument} (range: {min_pitch}-{max_pitch})")
-                    
-                    if rejected_count > 0:
-                        logging.info(f"[InstrumentAgent] Rejected {rejected_count} extremely out-of-range notes for {instrument} to preserve musicality")
-                    
-                    notes = valid_notes
-                    
-                    # Apply musical validation and smoothing
-                    if notes:
-                        # Apply musical validation and smoothing
-                        notes = validate_musical_flow(notes, instrument, genre, tempo)
-                        
-                        # Ensure musical coherence across the track
-                        notes = ensure_musical_coherence(notes, instrument, duration)
-                        
-                        # Add musical expression to avoid robotic sound
-                        notes = add_musical_expression(notes, instrument, genre, role)
-                    
-                    # Check coverage
-                    max_end = max(n['end'] for n in notes)
-                    coverage_ratio = max_end / (duration * 60)
-                    
-                    logging.info(f"[InstrumentAgent] {instrument} ({role}): {len(notes)} notes, "
-                                f"{coverage_ratio:.1%} coverage")
-                    
-                    # APPLY REAL MIDI PATTERNS to enhance the generated notes
-                    rag_patterns = state.get('rag_patterns', {})
-                    if rag_patterns:
-                        notes = apply_rag_patterns_to_notes(notes, rag_patterns, instrument, role, duration)
-                else:
-                    logging.warning(f"[InstrumentAgent] No notes generated for {instrument}")
-                    notes = []
-                
-                # Create track
-                track = {
-                    'name': f"{instrument.title()} ({role.title()})",
-                    'program': get_instrument_program(instrument),
-                    'is_drum': False,
-                    'notes': notes,
-                    'instrument': instrument,
-                    'role': role
-                }
-                
-                instrument_tracks.append(track)
-                
+                            task_outputs[t] = output
+        
+        # Tracks are built in request order since humanization draws from the shared random generator
+        for instrument, role, is_lead, pitch_range, t, octave_shift in track_plan:
+            try:
+                notes_array = retry_futures[t].result()[0] if t in retry_futures else task_outputs[t]
+                instrument_tracks.append(_build_track(notes_array, instrument, role, is_lead, pitch_range,
+                                                      genre, tempo, duration, rag_patterns, transpose=octave_shift))
             except Exception as e:
                 logging.error(f"[InstrumentAgent] Error generating {instrument} track: {e}")
                 continue
@@ -803,134 +1123,129 @@ def apply_real_midi_patterns(generated_notes, playable_patterns, instrument, rol
     Apply real MIDI patterns to enhance generated notes.
     """
     try:
-        if not playable_patterns or not generated_notes:
+        # Segment blending replaces a quarter of the notes and every other pass
+        # needs more than 5, so fewer than 4 notes can never change
+        note_count = len(generated_notes) if generated_notes else 0
+        if not playable_patterns or note_count < 4:
             return generated_notes
         
         logging.info(f"[InstrumentAgent] Applying real MIDI patterns to {instrument} ({role})")
         
-        enhanced_notes = generated_notes.copy()
+        # The note list is only rebuilt when segment notes are blended in; the other
+        # passes edit the note dicts themselves, which the old shallow copy shared anyway
+        enhanced_notes = generated_notes
         duration_seconds = duration_minutes * 60
         
         # Apply segments first (most valuable patterns)
-        if playable_patterns.get('segments') and len(generated_notes) > 0:
+        if playable_patterns.get('segments'):
             segment = playable_patterns['segments'][0]  # Use first segment
             
             # Find matching instrument in segment
             matching_inst = None
+            instrument_name = instrument.lower().replace('_', ' ')
             for seg_inst in segment.get('instruments', []):
-                if instrument.lower().replace('_', ' ') in seg_inst.get('name', '').lower():
+                if instrument_name in seg_inst.get('name', '').lower():
                     matching_inst = seg_inst
                     break
             
             if matching_inst and matching_inst.get('notes'):
-                # Apply segment notes as inspiration
-                segment_notes = []
-                for note_data in matching_inst['notes'][:20]:  # First 20 notes
-                    if len(note_data) >= 4:
-                        pitch, start, duration, velocity = note_data[:4]
-                        
-                        # Convert to our format
-                        segment_note = {
-                            'pitch': int(pitch),
-                            'start': float(start),
-                            'end': float(start + duration),
-                            'velocity': int(velocity)
-                        }
-                        segment_notes.append(segment_note)
+                # Apply segment notes as inspiration: [pitch, start, duration, velocity] rows
+                segment_rows = [note_data[:4] for note_data in matching_inst['notes'][:20]  # First 20 notes
+                                if len(note_data) >= 4]
                 
-                if segment_notes:
+                if segment_rows:
+                    segment = np.asarray(segment_rows, dtype=np.float64)
+                    
                     # Blend segment notes with generated notes
                     # Replace first 25% of generated notes with segment-inspired ones
-                    blend_count = min(len(segment_notes), len(enhanced_notes) // 4)
+                    blend_count = min(len(segment), len(enhanced_notes) // 4)
+                    segment = segment[:blend_count]
                     
-                    for i in range(blend_count):
-                        if i < len(segment_notes):
-                            # Scale timing to fit our duration
-                            segment_note = segment_notes[i].copy()
-                            time_scale = duration_seconds / 16.0  # Assume segment is ~16 seconds
-                            segment_note['start'] *= time_scale
-                            segment_note['end'] *= time_scale
-                            
-                            # Replace generated note with segment note
-                            enhanced_notes[i] = segment_note
+                    # Scale timing to fit our duration
+                    time_scale = duration_seconds / 16.0  # Assume segment is ~16 seconds
+                    starts = segment[:, 1] * time_scale
+                    ends = (segment[:, 1] + segment[:, 2]) * time_scale
+                    
+                    # Replace generated notes with segment notes (in a new list, the caller's is untouched)
+                    enhanced_notes = list(generated_notes)
+                    enhanced_notes[:blend_count] = (
+                        {'pitch': int(p), 'start': s, 'end': e, 'velocity': int(v)}
+                        for p, s, e, v in zip(segment[:, 0].tolist(), starts.tolist(), ends.tolist(), segment[:, 3].tolist())
+                    )
                     
                     logging.info(f"[InstrumentAgent] Applied {blend_count} segment notes to {instrument}")
         
-        # Apply melodic sequences if it's a lead instrument
+        if note_count <= 5:
+            return enhanced_notes
+        
+        # Resolve every pattern first, then apply them in a single pass over the notes
+        # Melodic sequences for lead instruments: up to 10 intervals from 1/3 through the track
+        melody_intervals = []
         if role == 'lead' and playable_patterns.get('melodies'):
-            melody_pattern = playable_patterns['melodies'][0]
-            intervals = melody_pattern.get('intervals', [])
-            
-            if intervals and len(enhanced_notes) > 10:
-                # Apply intervals to modify existing melody
-                start_idx = len(enhanced_notes) // 3  # Start from 1/3 through
-                
-                for i, interval in enumerate(intervals[:10]):  # Apply up to 10 intervals
-                    note_idx = start_idx + i
-                    if note_idx < len(enhanced_notes):
-                        # Apply interval to modify pitch
-                        enhanced_notes[note_idx]['pitch'] += interval
-                        # Keep in reasonable range
-                        enhanced_notes[note_idx]['pitch'] = max(24, min(108, enhanced_notes[note_idx]['pitch']))
-                
-                logging.info(f"[InstrumentAgent] Applied melodic intervals to {instrument}")
+            intervals = playable_patterns['melodies'][0].get('intervals', [])
+            if intervals and note_count > 10:
+                melody_intervals = intervals[:10]
+        melody_start = note_count // 3
         
-        # Apply chord progressions for backing instruments
-        if role in ['backing', 'supporting'] and playable_patterns.get('chord_progressions'):
-            chord_pattern = playable_patterns['chord_progressions'][0]
-            chords = chord_pattern.get('chords', [])
-            
-            if chords and len(enhanced_notes) > 5:
-                # Apply chord tones to some notes
-                chord_idx = 0
-                
-                for i, note in enumerate(enhanced_notes):
-                    if i % 4 == 0:  # Every 4th note
-                        if chord_idx < len(chords):
-                            chord = chords[chord_idx]
-                            pitches = chord.get('pitches', [0, 4, 7])
-                            
-                            # Choose a chord tone
-                            chosen_pitch_class = pitches[i % len(pitches)]
-                            
-                            # Apply to note (keeping octave similar)
-                            current_octave = note['pitch'] // 12
-                            new_pitch = current_octave * 12 + chosen_pitch_class
-                            
-                            # Adjust octave if needed
-                            if abs(new_pitch - note['pitch']) > 6:  # More than tritone
-                                if new_pitch > note['pitch']:
-                                    new_pitch -= 12
-                                else:
-                                    new_pitch += 12
-                            
-                            enhanced_notes[i]['pitch'] = max(24, min(108, new_pitch))
-                            chord_idx = (chord_idx + 1) % len(chords)
-                
-                logging.info(f"[InstrumentAgent] Applied chord progressions to {instrument}")
+        # Chord progressions for backing instruments: a chord tone on every 4th note
+        chords = []
+        if role in _BACKING_ROLES and playable_patterns.get('chord_progressions'):
+            progression_chords = playable_patterns['chord_progressions'][0].get('chords', [])
+            if progression_chords:
+                chords = progression_chords
         
-        # Apply rhythm patterns
+        # Rhythm patterns: retime the first 20 notes
+        rhythm_intervals = []
         if playable_patterns.get('rhythm_patterns'):
-            rhythm_pattern = playable_patterns['rhythm_patterns'][0]
-            intervals = rhythm_pattern.get('intervals', [])
+            intervals = playable_patterns['rhythm_patterns'][0].get('intervals', [])
+            if intervals:
+                rhythm_intervals = intervals
+        
+        # Only walk as far as the furthest note any pass touches
+        if chords:
+            stop = note_count
+        else:
+            stop = max(melody_start + len(melody_intervals) if melody_intervals else 0,
+                       20 if rhythm_intervals else 0)
+        
+        chord_idx = 0
+        interval_idx = 0
+        current_time = 0.0
+        for i in range(min(stop, note_count)):
+            note = enhanced_notes[i]
+            
+            # Apply interval to modify pitch, keeping it in a reasonable range
+            if 0 <= i - melody_start < len(melody_intervals):
+                note['pitch'] = _clamp_pitch(note['pitch'] + melody_intervals[i - melody_start])
             
-            if intervals and len(enhanced_notes) > 5:
-                # Adjust note timing based on rhythm pattern
-                interval_idx = 0
-                current_time = 0.0
+            # Choose a chord tone, keeping the octave similar
+            if chords and i % 4 == 0:
+                pitches = chords[chord_idx].get('pitches', [0, 4, 7])
+                chosen_pitch_class = pitches[i % len(pitches)]
+                new_pitch = (note['pitch'] // 12) * 12 + chosen_pitch_class
                 
-                for i, note in enumerate(enhanced_notes[:20]):  # First 20 notes
-                    if interval_idx < len(intervals):
-                        target_interval = intervals[interval_idx]
-                        
-                        # Adjust note timing
-                        enhanced_notes[i]['start'] = current_time
-                        enhanced_notes[i]['end'] = current_time + min(target_interval, 2.0)
-                        
-                        current_time += target_interval
-                        interval_idx = (interval_idx + 1) % len(intervals)
+                # Adjust octave if needed
+                if abs(new_pitch - note['pitch']) > 6:  # More than tritone
+                    new_pitch += -12 if new_pitch > note['pitch'] else 12
+                
+                note['pitch'] = _clamp_pitch(new_pitch)
+                chord_idx = (chord_idx + 1) % len(chords)
+            
+            # Adjust note timing based on rhythm pattern
+            if rhythm_intervals and i < 20:
+                target_interval = rhythm_intervals[interval_idx]
+                note['start'] = current_time
+                note['end'] = current_time + min(target_interval, 2.0)
                 
-                logging.info(f"[InstrumentAgent] Applied rhythm patterns to {instrument}")
+                current_time += target_interval
+                interval_idx = (interval_idx + 1) % len(rhythm_intervals)
+        
+        if melody_intervals:
+            logging.info(f"[InstrumentAgent] Applied melodic intervals to {instrument}")
+        if chords:
+            logging.info(f"[InstrumentAgent] Applied chord progressions to {instrument}")
+        if rhythm_intervals:
+            logging.info(f"[InstrumentAgent] Applied rhythm patterns to {instrument}")
         
         return enhanced_notes
         
@@ -938,90 +1253,138 @@ def apply_real_midi_patterns(generated_notes, playable_patterns, instrument, rol
         logging.error(f"[InstrumentAgent] Error applying MIDI patterns to {instrument}: {e}")
         return generated_notes
 
-def apply_rag_patterns_to_notes(notes, rag_patterns, instrument, role, duration):
+# Pattern instrument names that count as a match for string instruments
+_STRING_NAMES = ('violin', 'cello', 'string')
+
+# One contiguous record per note; times stay float64 so rescaling does not round them
+_NOTE_DTYPE = np.dtype([('pitch', np.int64), ('start', np.float64), ('end', np.float64), ('velocity', np.int64)])
+
+def _notes_to_record(notes, notes_are_dicts):
+    """Pack note dicts or [pitch, start, end, velocity] lists into a structured array in one pass."""
+    if notes_are_dicts:
+        rows = [(n.get('pitch', 60), n.get('start', 0), n.get('end', n.get('start', 0) + 0.5), n.get('velocity', 80))
+                for n in notes]
+    else:
+        rows = [tuple(n[:4]) for n in notes]
+    return np.array(rows, dtype=_NOTE_DTYPE)
+
+def _write_back_notes(notes, record, fields, notes_are_dicts):
+    """Copy the given record fields back onto the original notes in place."""
+    for field in fields:
+        # Dicts are keyed by field name, list notes by the field's position
+        key = field if notes_are_dicts else _NOTE_DTYPE.names.index(field)
+        for note, value in zip(notes, record[field].tolist()):
+            note[key] = value
+
+@lru_cache(maxsize=1024)
+def _pattern_matches_instrument(pattern_name, instrument_lower):
+    """Whether a lower-cased pattern instrument name should lend its patterns to this instrument."""
+    return (instrument_lower in pattern_name or
+            pattern_name in instrument_lower or
+            ('piano' in instrument_lower and 'piano' in pattern_name) or
+            ('guitar' in instrument_lower and 'guitar' in pattern_name) or
+            ('string' in instrument_lower and any(s in pattern_name for s in _STRING_NAMES)))
+
+def _snap_to_chord_tones(pitch, roots):
     """
-    Apply RAG-retrieved patterns to enhance generated notes with real MIDI data
+    Move non-chord tones within 2 semitones onto the nearest chord root (by pitch class),
+    keeping results inside the 21-108 piano range. Pure numeric, operates on whole arrays.
+    """
+    note_class = pitch % 12
+    distances = np.abs(note_class[:, None] - roots[None, :])
+    nearest = distances.argmin(axis=1)
+    min_distance = distances[np.arange(len(pitch)), nearest]
+    
+    # Handle octave wrap: fold the adjustment into [-6, 6) without branching
+    adjustment = (roots[nearest] - note_class + 6) % 12 - 6
+    new_pitch = pitch + adjustment
+    
+    # Only non-chord tones within 2 semitones that stay in piano range move
+    snap = ((min_distance > 0) & (min_distance <= 2) &
+            (new_pitch >= 21) & (new_pitch <= 108))
+    return np.where(snap, new_pitch, pitch)
+
+def apply_rag_patterns_to_notes(notes, rag_patterns, instrument, role, duration, record=None):
+    """
+    Apply RAG-retrieved patterns to enhance generated notes with real MIDI data.
+    A caller that already packed the notes with _notes_to_record can pass that record in.
     """
     try:
         if not rag_patterns or not notes:
             return notes
         
-        # Get relevant patterns for this instrument
-        segments = rag_patterns.get('segments', [])
-        progressions = rag_patterns.get('progressions', [])
+        # Get relevant patterns for this instrument; chord progressions only apply to lead roles,
+        # so return before building the note record when nothing can change
+        segments = rag_patterns.get('segments', [])[:2]  # Use top 2 segments
+        progressions = rag_patterns.get('progressions', [])[:1] if role in _LEAD_ROLES else []  # Use top progression
+        if not segments and not progressions:
+            return notes
+        
+        note_count = len(notes)
+        instrument_lower = instrument.lower()
         
-        enhanced_notes = []
+        # Pattern transforms run on a structured array; notes are updated once at the end.
+        # The note representation (dicts or lists) is detected once here.
+        notes_are_dicts = isinstance(notes[0], dict)
+        if record is None:
+            record = _notes_to_record(notes, notes_are_dicts)
+        changed_fields = []
         
         # Apply segment patterns if available
-        for segment in segments[:2]:  # Use top 2 segments
+        for segment in segments:
             pattern_data = segment.get('pattern_data', {})
             if not pattern_data:
                 continue
                 
             pattern_instruments = pattern_data.get('instruments', [])
             
-            # Find matching instrument patterns
-            for pattern_inst in pattern_instruments:
-                pattern_name = pattern_inst.get('name', '').lower()
-                
-                # Match instrument types
-                if (instrument.lower() in pattern_name or 
-                    pattern_name in instrument.lower() or
-                    ('piano' in instrument.lower() and 'piano' in pattern_name) or
-                    ('guitar' in instrument.lower() and 'guitar' in pattern_name) or
-                    ('string' in instrument.lower() and any(s in pattern_name for s in ['violin', 'cello', 'string']))):
+            # Keep only the pattern instruments that match; skip the segment when none do
+            matching_instruments = [
+                pattern_inst for pattern_inst in pattern_instruments
+                if _pattern_matches_instrument(pattern_inst.get('name', '').lower(), instrument_lower)
+            ]
+            if not matching_instruments:
+                continue
+            
+            for pattern_inst in matching_instruments:
+                # Apply pattern characteristics
+                pattern_notes = pattern_inst.get('notes', [])
+                if pattern_notes:
+                    # Extract timing and velocity patterns from the first 20 notes
+                    # (dicts, or [pitch, start, end, velocity] rows)
+                    pattern_head = [note for note in pattern_notes[:20]
+                                    if isinstance(note, dict) or (isinstance(note, (list, tuple)) and len(note) >= 4)]
+                    pattern_velocities = np.asarray(
+                        [note.get('velocity', 80) if isinstance(note, dict) else note[3] for note in pattern_head],
+                        dtype=np.float64)
+                    pattern_durations = np.asarray(
+                        [note.get('duration', 0.5) if isinstance(note, dict) else note[2] - note[1] for note in pattern_head],
+                        dtype=np.float64)
                     
-                    # Apply pattern characteristics
-                    pattern_notes = pattern_inst.get('notes', [])
-                    if pattern_notes:
-                        # Extract timing and velocity patterns
-                        pattern_intervals = []
-                        pattern_velocities = []
-                        pattern_durations = []
-                        
-                        for note in pattern_notes[:20]:  # First 20 notes
-                            if isinstance(note, dict):
-                                pattern_velocities.append(note.get('velocity', 80))
-                                pattern_durations.append(note.get('duration', 0.5))
-                            elif isinstance(note, (list, tuple)) and len(note) >= 4:
-                                pattern_velocities.append(note[3])
-                                if len(note) >= 3:
-                                    pattern_durations.append(note[2] - note[1])
+                    # Apply pattern characteristics to generated notes
+                    if len(pattern_velocities):
+                        avg_pattern_velocity = pattern_velocities.mean()
+                        velocity_factor = avg_pattern_velocity / 80.0  # Normalize around 80
                         
-                        # Apply pattern characteristics to generated notes
-                        if pattern_velocities and len(notes) > 0:
-                            avg_pattern_velocity = sum(pattern_velocities) / len(pattern_velocities)
-                            velocity_factor = avg_pattern_velocity / 80.0  # Normalize around 80
-                            
-                            # Adjust velocities based on pattern
-                            for note in notes:
-                                if isinstance(note, dict):
-                                    note['velocity'] = int(min(127, max(20, note.get('velocity', 80) * velocity_factor)))
-                                elif isinstance(note, list) and len(note) >= 4:
-                                    note[3] = int(min(127, max(20, note[3] * velocity_factor)))
+                        # Adjust velocities based on pattern
+                        record['velocity'] = np.clip(record['velocity'] * velocity_factor, 20, 127)
+                        changed_fields.append('velocity')
+                    
+                    # Apply rhythmic patterns if available
+                    if len(pattern_durations) and note_count > 1:
+                        avg_pattern_duration = pattern_durations.mean()
+                        duration_factor = max(0.1, min(2.0, avg_pattern_duration / 0.5))  # Reasonable bounds
                         
-                        # Apply rhythmic patterns if available
-                        if pattern_durations and len(notes) > 1:
-                            avg_pattern_duration = sum(pattern_durations) / len(pattern_durations)
-                            duration_factor = max(0.1, min(2.0, avg_pattern_duration / 0.5))  # Reasonable bounds
-                            
-                            # Adjust note durations
-                            for i, note in enumerate(notes):
-                                if isinstance(note, dict):
-                                    current_duration = note.get('end', note.get('start', 0) + 0.5) - note.get('start', 0)
-                                    new_duration = current_duration * duration_factor
-                                    note['end'] = note.get('start', 0) + new_duration
-                                elif isinstance(note, list) and len(note) >= 3:
-                                    current_duration = note[2] - note[1]
-                                    new_duration = current_duration * duration_factor
-                                    note[2] = note[1] + new_duration
+                        # Adjust note durations
+                        record['end'] = record['start'] + (record['end'] - record['start']) * duration_factor
+                        changed_fields.append('end')
         
         # Apply chord progression patterns
-        for progression in progressions[:1]:  # Use top progression
+        for progression in progressions:
             pattern_data = progression.get('pattern_data', {})
             chords = pattern_data.get('chords', [])
             
-            if chords and role in ['lead', 'melody', 'harmony']:
+            if chords:
                 # Extract harmonic content to influence note choices
                 chord_roots = []
                 for chord in chords[:8]:  # First 8 chords
@@ -1031,34 +1394,12 @@ def apply_rag_patterns_to_notes(notes, rag_patterns, instrument, role, duration)
                 
                 if chord_roots:
                     # Bias notes toward chord tones
-                    for note in notes:
-                        if isinstance(note, dict):
-                            pitch = note.get('pitch', 60)
-                        elif isinstance(note, list) and len(note) >= 1:
-                            pitch = note[0]
-                        else:
-                            continue
-                        
-                        # Find closest chord root
-                        note_class = pitch % 12
-                        if note_class not in chord_roots:
-                            # Find nearest chord tone
-                            distances = [abs(note_class - root) for root in chord_roots]
-                            min_distance = min(distances)
-                            if min_distance <= 2:  # Within 2 semitones
-                                closest_root = chord_roots[distances.index(min_distance)]
-                                adjustment = closest_root - note_class
-                                if abs(adjustment) > 6:  # Handle octave wrap
-                                    adjustment = adjustment - 12 if adjustment > 0 else adjustment + 12
-                                
-                                new_pitch = pitch + adjustment
-                                if 21 <= new_pitch <= 108:  # Piano range
-                                    if isinstance(note, dict):
-                                        note['pitch'] = new_pitch
-                                    elif isinstance(note, list):
-                                        note[0] = new_pitch
+                    record['pitch'] = _snap_to_chord_tones(record['pitch'], np.asarray(chord_roots))
+                    changed_fields.append('pitch')
+        
+        _write_back_notes(notes, record, dict.fromkeys(changed_fields), notes_are_dicts)
         
-        logging.info(f"[RAG Pattern Application] Enhanced {len(notes)} notes for {instrument} using real MIDI patterns")
+        logging.info(f"[RAG Pattern Application] Enhanced {note_count} notes for {instrument} using real MIDI patterns")
         return notes
         
     except Exception as e:
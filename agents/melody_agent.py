@@ -1,93 +1,284 @@
 import logging
 from typing import Any
-from utils.gemini_llm import gemini_generate
+from utils.gemini_llm import cached_gemini_generate
 from utils.state_utils import validate_agent_return, safe_state_update
 import ast
 import math
 import re
 import json
 import random
+from bisect import bisect_left
+from functools import lru_cache
+from types import MappingProxyType
+import numpy as np
 
-def quantize_time(time, step=0.25):
-    return round(time / step) * step
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# Faster note-array decoding when orjson is installed
+_json_loads = orjson.loads if orjson is not None else json.loads
+
+_FENCE_RE = re.compile(r"^```[a-zA-Z]*\n?|```$", re.MULTILINE)
+
+# Rest lengths the interval walk inserts between phrases
+_REST_LENGTHS = (0.25, 0.5)
+
+# Per-section transposition by section index mod 3: unchanged, up a major second, down a major second
+_SECTION_PITCH_SHIFTS = (0, 2, -2)
+
+# Where pitch/start/end/velocity live in a note dict and in a raw [pitch, start, end, velocity] row
+_DICT_NOTE_FIELDS = ('pitch', 'start', 'end', 'velocity')
+_ROW_NOTE_FIELDS = (0, 1, 2, 3)
+
+# Velocities (70-90) for notes generated by the interval walk
+_WALK_VELOCITIES = range(70, 91)
+
+# Velocity offsets (-10 to +10) applied to notes taken directly from RAG data
+_VELOCITY_JITTER = range(-10, 11)
+
+# Section kinds with dedicated melodic guidance, checked in this order
+_SECTION_KINDS = ('verse', 'chorus', 'bridge', 'intro', 'outro')
+
+# Melodic characteristics per section kind, filled in from the director's section plan
+_SECTION_CHARACTERISTICS = MappingProxyType({
+    'verse': "narrative melodic line (energy: {energy_level}/10), {emotional_character}, {complexity_level} complexity",
+    'chorus': "memorable hook (energy: {energy_level}/10), {emotional_character}, increased melodic prominence",
+    'bridge': "contrasting melodic material (energy: {energy_level}/10), {emotional_character}, unique approach",
+    'intro': "establishing theme (energy: {energy_level}/10), building anticipation, {complexity_level} complexity",
+    'outro': "concluding material (energy: {energy_level}/10), resolution or fade approach",
+    'other': "section-appropriate development (energy: {energy_level}/10), {emotional_character}",
+})
+
+def section_kind_of(section_name_lower):
+    """The first section kind named in a lower-cased section name, or 'other'."""
+    return next((kind for kind in _SECTION_KINDS if kind in section_name_lower), 'other')
+
+# Melodic and rhythmic guidance by requested complexity
+_COMPLEXITY_GUIDANCE = MappingProxyType({
+    'simple': 'Use mostly stepwise motion, simple rhythms, clear phrases',
+    'medium': 'Mix stepwise and leap motion, varied rhythms, interesting phrases',
+    'complex': 'Include large intervals, syncopation, extended phrases, melodic ornamentation'
+})
+
+_RHYTHM_GUIDANCE = MappingProxyType({
+    'simple': 'Mostly quarter and eighth notes, minimal syncopation',
+    'medium': 'Mix of note values, moderate syncopation, some rests',
+    'complex': 'Complex rhythmic patterns, polyrhythms, advanced syncopation'
+})
+
+# Genre-specific melodic requirements appended to the prompt
+_METAL_ROCK_MELODY = """
+        - Use aggressive melodic intervals and power-chord friendly notes
+        - Include fast scalar runs and chromatic passing tones
+        - Emphasize strong downbeats and syncopated rhythms
+        - Use palm-muted sections and sustained power notes
+        - Include dramatic octave leaps and aggressive bends
+        - Pitch range: 45-75 (melody should complement guitar, not compete)
+        """
+
+_JAZZ_MELODY = """
+        - Use complex chord tones, extensions (9ths, 11ths, 13ths)
+        - Include blue notes, chromatic approach tones
+        - Swing rhythm patterns with triplet subdivisions
+        - Sophisticated harmonic movement and voice leading
+        - Pitch range: 55-85 (jazz melody range)
+        """
+
+_CLASSICAL_MELODY = """
+        - Use stepwise motion with tasteful leaps
+        - Classical phrase structures with clear cadences
+        - Ornamentations like trills, turns, grace notes
+        - Balanced melodic contour with arch-like phrases
+        - Pitch range: 55-80 (classical melody range)
+        """
+
+_ELECTRONIC_MELODY = """
+        - Use synthesizer-friendly intervals and patterns
+        - Include filter sweeps, arpeggiated sequences
+        - Rhythmic patterns aligned to electronic beats
+        - Repetitive but evolving melodic phrases
+        - Pitch range: 50-90 (wide electronic range)
+        """
+
+_BLUES_MELODY = """
+        - Heavily use blue notes (♭3, ♭5, ♭7)
+        - Call-and-response melodic phrases
+        - Bending and sliding between pitches
+        - 12-bar blues structure awareness
+        - Pitch range: 50-75 (blues vocal/instrumental range)
+        """
+
+_FOLK_COUNTRY_MELODY = """
+        - Simple, singable melodic lines
+        - Pentatonic and modal scales
+        - Clear phrase structure with repetition
+        - Natural speech rhythm patterns
+        - Pitch range: 55-75 (vocal-friendly range)
+        """
+
+_POP_MELODY = """
+        - Catchy, memorable melodic hooks
+        - Mix of stepwise motion and moderate leaps
+        - Clear phrase structure with repetition and variation
+        - Accessible melodic content for broad appeal
+        - Pitch range: 55-78 (pop melody range)
+        """
+
+# Genre keywords and their melodic requirements, checked in this order; pop covers everything else
+_GENRE_MELODY_BLOCKS = (
+    ('metal', _METAL_ROCK_MELODY),
+    ('rock', _METAL_ROCK_MELODY),
+    ('jazz', _JAZZ_MELODY),
+    ('classical', _CLASSICAL_MELODY),
+    ('electronic', _ELECTRONIC_MELODY),
+    ('edm', _ELECTRONIC_MELODY),
+    ('blues', _BLUES_MELODY),
+    ('folk', _FOLK_COUNTRY_MELODY),
+    ('country', _FOLK_COUNTRY_MELODY),
+)
+
+# Tempo-specific rhythmic requirements appended to the prompt
+_SLOW_TEMPO_RHYTHM = """
+        - Use longer note values (half notes, whole notes)
+        - Include expressive rubato and ritardando
+        - Fewer but more meaningful melodic events
+        - Allow for breath and space between phrases
+        """
+
+_MEDIUM_TEMPO_RHYTHM = """
+        - Balanced mix of quarter and eighth notes
+        - Moderate rhythmic activity with clear pulse
+        - Natural breathing points in phrases
+        - Syncopation for interest but not overwhelming
+        """
+
+_FAST_TEMPO_RHYTHM = """
+        - Emphasis on eighth and sixteenth note patterns
+        - Active rhythmic movement with driving pulse
+        - Quick melodic passages and energetic phrases
+        - Strategic use of rests for rhythmic punch
+        """
+
+_VERY_FAST_TEMPO_RHYTHM = """
+        - Rapid sixteenth note passages and scalar runs
+        - Aggressive rhythmic patterns with strong accents
+        - Short, punchy melodic cells repeated and developed
+        - Minimal rests - continuous melodic energy
+        """
+
+# Upper tempo bounds (exclusive) and their rhythmic requirements, checked in this order; anything faster is very fast
+_TEMPO_RHYTHM_BLOCKS = (
+    (80, _SLOW_TEMPO_RHYTHM),
+    (120, _MEDIUM_TEMPO_RHYTHM),
+    (160, _FAST_TEMPO_RHYTHM),
+)
 
 def clean_llm_output(text):
     # Remove code block markers and leading/trailing whitespace
-    return re.sub(r"^```[a-zA-Z]*\n?|```$", "", text.strip(), flags=re.MULTILINE).strip()
+    return _FENCE_RE.sub("", text.strip()).strip()
 
 def safe_literal_eval(text):
-    # Try normal parse
+    # Auto-close truncated output before the first parse
+    missing_square = text.count('[') - text.count(']')
+    missing_curly = text.count('{') - text.count('}')
+    if missing_square > 0 or missing_curly > 0:
+        repaired = text + (']' * max(missing_square, 0)) + ('}' * max(missing_curly, 0))
+        try:
+            return _json_loads(repaired)
+        except ValueError:
+            pass
+        try:
+            return ast.literal_eval(repaired)
+        except Exception:
+            pass  # Fall back to the raw text
+    # JSON first, ast only as a fallback
+    try:
+        return _json_loads(text)
+    except ValueError:
+        pass
     try:
         return ast.literal_eval(text)
-    except Exception:
-        # Try to auto-close brackets
-        if text.count('[') > text.count(']'):
-            text = text + (']' * (text.count('[') - text.count(']')))
-        if text.count('{') > text.count('}'):
-            text = text + ('}' * (text.count('{') - text.count('}')))
-        try:
-            return ast.literal_eval(text)
-        except Exception as e:
-            logging.error(f"[MelodyAgent] Failed to parse LLM output after auto-fix: {e}")
-            return []
+    except Exception as e:
+        logging.error(f"[MelodyAgent] Failed to parse LLM output after auto-fix: {e}")
+        return []
 
-def notes_array_to_dicts(notes_array):
-    return [
-        {'pitch': n[0], 'start': n[1], 'end': n[2], 'velocity': n[3]}
-        for n in notes_array if isinstance(n, (list, tuple)) and len(n) == 4
-    ]
+def draw_in_blocks(population, block_size=64):
+    """Endless uniform picks from population, drawn with one random.choices call per block."""
+    while True:
+        yield from random.choices(population, k=block_size)
 
-def melody_agent(state: Any) -> Any:
+def finalize_note_columns(starts, ends, velocities):
     """
-    Generate sophisticated, context-aware melodies with dynamic section variations.
+    Quantize start-sorted note columns to the 0.25 grid in place, stretch non-positive
+    durations to a sixteenth and clamp velocities to 40-120. Returns the clamped
+    velocities and the sorted unique onsets.
     """
-    logging.info("[MelodyAgent] Generating sophisticated melody with comprehensive context.")
+    # rint rounds half to even like round()
+    for times in (starts, ends):
+        np.multiply(times, 4.0, out=times)
+        np.rint(times, out=times)
+        np.multiply(times, 0.25, out=times)
+    np.copyto(ends, starts + 0.25, where=ends <= starts)
     
+    # The clamped column keeps integer velocities integral
+    velocities = np.clip(velocities, 40, 120)
+    
+    # Quantized starts are still in order, so unique() only has to drop repeats
+    return velocities, np.unique(starts)
+
+@lru_cache(maxsize=256)
+def parse_pattern_data(pattern_json):
+    """
+    Decode a RAG pattern_data JSON string, or {} if it is not valid JSON. Memoized because
+    the same retrieved patterns recur across calls, so the result is shared and must not be mutated.
+    """
     try:
-        # Extract comprehensive context
-        artist_profile = state.get('artist_profile', {})
-        musical_context = state.get('musical_context', {})
-        musical_vision = state.get('musical_vision', {})
-        arrangement_guidelines = state.get('arrangement_guidelines', {})
-        section_arrangement_plan = state.get('section_arrangement_plan', {})
-        structured_sections = state.get('structured_sections', [])
-        director_summary = state.get('director_summary', '')
-        
-        # Get RAG patterns if available
-        rag_patterns = state.get('rag_patterns', {})
-        rag_melodies = rag_patterns.get('melodies', [])
-        rag_segments = rag_patterns.get('segments', [])
-        rag_instructions = state.get('rag_instructions', '')
-        
-        logging.info(f"[MelodyAgent] Found {len(rag_melodies)} RAG melody patterns and {len(rag_segments)} segments")
-        
-        # Basic parameters
-        genre = musical_context.get('full_genre', state.get('genre', 'pop'))
-        mood = musical_context.get('full_mood', state.get('mood', 'happy'))
-        tempo = state.get('tempo', 120)
-        duration = state.get('duration', 2)
-        key_signature = state.get('key_signature', 'C major')
-        time_signature = state.get('time_signature', '4/4')
-        
-        # Complexity and style parameters
-        harmonic_complexity = state.get('harmonic_complexity', 'medium')
-        rhythmic_complexity = state.get('rhythmic_complexity', 'medium')
-        emotional_arc = state.get('emotional_arc', '')
-        special_techniques = state.get('special_techniques', '')
-        instrument_description = state.get('instrument_description', '')
-        
-        # Artist-specific characteristics
-        melody_characteristics = artist_profile.get('melody_characteristics', 'expressive melodic lines with natural phrasing')
-        signature_sounds = artist_profile.get('signature_sounds', '')
-        style_summary = artist_profile.get('style_summary', '')
-        
-        # Musical director's vision
-        melodic_character = musical_vision.get('melodic_character', 'memorable, expressive themes')
-        emotional_narrative = musical_vision.get('emotional_narrative', 'engaging emotional development')
-        dynamic_architecture = musical_vision.get('dynamic_architecture', 'thoughtful dynamic progression')
-        
-        # Build comprehensive prompt
-        context_description = f"""
+        return _json_loads(pattern_json)
+    except Exception:
+        return {}
+
+def build_melody_prompt(state, rag_melodies_data, rag_segment_notes):
+    """
+    Assemble the LLM melody prompt from the state and the RAG patterns extracted by
+    melody_agent. Only the LLM fallback needs it, so it is built on demand.
+    """
+    # Extract comprehensive context
+    artist_profile = state.get('artist_profile', {})
+    musical_context = state.get('musical_context', {})
+    musical_vision = state.get('musical_vision', {})
+    section_arrangement_plan = state.get('section_arrangement_plan', {})
+    structured_sections = state.get('structured_sections', [])
+    director_summary = state.get('director_summary', '')
+    
+    # Basic parameters
+    genre = musical_context.get('full_genre', state.get('genre', 'pop'))
+    mood = musical_context.get('full_mood', state.get('mood', 'happy'))
+    tempo = state.get('tempo', 120)
+    duration = state.get('duration', 2)
+    key_signature = state.get('key_signature', 'C major')
+    time_signature = state.get('time_signature', '4/4')
+    
+    # Complexity and style parameters
+    harmonic_complexity = state.get('harmonic_complexity', 'medium')
+    rhythmic_complexity = state.get('rhythmic_complexity', 'medium')
+    emotional_arc = state.get('emotional_arc', '')
+    special_techniques = state.get('special_techniques', '')
+    instrument_description = state.get('instrument_description', '')
+    
+    # Artist-specific characteristics
+    melody_characteristics = artist_profile.get('melody_characteristics', 'expressive melodic lines with natural phrasing')
+    signature_sounds = artist_profile.get('signature_sounds', '')
+    style_summary = artist_profile.get('style_summary', '')
+    
+    # Musical director's vision
+    melodic_character = musical_vision.get('melodic_character', 'memorable, expressive themes')
+    emotional_narrative = musical_vision.get('emotional_narrative', 'engaging emotional development')
+    dynamic_architecture = musical_vision.get('dynamic_architecture', 'thoughtful dynamic progression')
+    
+    # Build comprehensive prompt
+    context_description = f"""
         Create a {genre} melody with {mood} emotional character following this artistic vision:
         
         MUSICAL DIRECTOR'S GUIDANCE:
@@ -113,50 +304,130 @@ def melody_agent(state: Any) -> Any:
         {f'- Special Techniques: {special_techniques}' if special_techniques else ''}
         {f'- Performance Instructions: {instrument_description}' if instrument_description else ''}
         """
+    
+    # Add section-specific instructions with director's plan
+    section_instructions = ""
+    if structured_sections and len(structured_sections) > 2:
+        section_lines = ["\nCREATE DISTINCT MELODIC CONTENT FOR EACH SECTION FOLLOWING THE DIRECTOR'S PLAN:\n"]
+        for i, section in enumerate(structured_sections):
+            section_start = section['start_time']
+            section_end = section['end_time']
+            section_name = section['name'].upper()
+            section_name_lower = section['name'].lower()
+            
+            # Get director's plan for this section if available
+            section_plan = section_arrangement_plan.get(section['name'], {})
+            energy_level = section_plan.get('energy_level', 5)
+            complexity_level = section_plan.get('complexity_level', 'medium')
+            emotional_character = section_plan.get('emotional_character', mood)
+            
+            # Define section characteristics enhanced by director's vision
+            characteristics = _SECTION_CHARACTERISTICS[section_kind_of(section_name_lower)].format(
+                energy_level=energy_level,
+                emotional_character=emotional_character,
+                complexity_level=complexity_level,
+            )
+            
+            section_lines.append(f"- {section_name} ({section_start:.1f}s-{section_end:.1f}s): {characteristics}\n")
+        section_instructions = "".join(section_lines)
+    
+    # Create summarized prompt instructions from extracted data
+    rag_pattern_lines = []
+    
+    if rag_melodies_data or rag_segment_notes:
+        rag_pattern_lines.append("\n\nIMPORTANT: INCORPORATING THESE RAG MELODIC PATTERNS:\n")
+        
+        if rag_melodies_data:
+            rag_pattern_lines.append("\nMELODIC INTERVAL PATTERNS USED:\n")
+            rag_pattern_lines.extend(
+                f"- Pattern {i+1}: Using {len(melody['intervals'])} intervals from {melody['instrument']} source\n"
+                for i, melody in enumerate(rag_melodies_data[:2])
+            )
+        
+        if rag_segment_notes:
+            rag_pattern_lines.append("\nACTUAL NOTE SEQUENCES USED:\n")
+            rag_pattern_lines.extend(
+                f"- Sequence {i+1}: Using {len(segment['notes'])} notes from {segment['instrument']}\n"
+                for i, segment in enumerate(rag_segment_notes[:2])
+            )
+    
+    rag_pattern_instructions = "".join(rag_pattern_lines)
+    
+    prompt_parts = [f"""
+        {context_description}
         
-        # Add section-specific instructions with director's plan
-        section_instructions = ""
-        if structured_sections and len(structured_sections) > 2:
-            section_instructions = "\nCREATE DISTINCT MELODIC CONTENT FOR EACH SECTION FOLLOWING THE DIRECTOR'S PLAN:\n"
-            for i, section in enumerate(structured_sections):
-                section_start = section['start_time']
-                section_end = section['end_time']
-                section_name = section['name'].upper()
-                
-                # Get director's plan for this section if available
-                section_plan = section_arrangement_plan.get(section['name'], {})
-                energy_level = section_plan.get('energy_level', 5)
-                complexity_level = section_plan.get('complexity_level', 'medium')
-                emotional_character = section_plan.get('emotional_character', mood)
-                
-                # Define section characteristics enhanced by director's vision
-                if 'verse' in section['name'].lower():
-                    characteristics = f"narrative melodic line (energy: {energy_level}/10), {emotional_character}, {complexity_level} complexity"
-                elif 'chorus' in section['name'].lower():
-                    characteristics = f"memorable hook (energy: {energy_level}/10), {emotional_character}, increased melodic prominence"
-                elif 'bridge' in section['name'].lower():
-                    characteristics = f"contrasting melodic material (energy: {energy_level}/10), {emotional_character}, unique approach"
-                elif 'intro' in section['name'].lower():
-                    characteristics = f"establishing theme (energy: {energy_level}/10), building anticipation, {complexity_level} complexity"
-                elif 'outro' in section['name'].lower():
-                    characteristics = f"concluding material (energy: {energy_level}/10), resolution or fade approach"
-                else:
-                    characteristics = f"section-appropriate development (energy: {energy_level}/10), {emotional_character}"
-                
-                section_instructions += f"- {section_name} ({section_start:.1f}s-{section_end:.1f}s): {characteristics}\n"
+        {section_instructions}
         
-        # Dynamic complexity mapping
-        complexity_guidance = {
-            'simple': 'Use mostly stepwise motion, simple rhythms, clear phrases',
-            'medium': 'Mix stepwise and leap motion, varied rhythms, interesting phrases',
-            'complex': 'Include large intervals, syncopation, extended phrases, melodic ornamentation'
-        }
+        COMPLEXITY GUIDELINES:
+        - Melodic: {_COMPLEXITY_GUIDANCE.get(harmonic_complexity, _COMPLEXITY_GUIDANCE['medium'])}
+        - Rhythmic: {_RHYTHM_GUIDANCE.get(rhythmic_complexity, _RHYTHM_GUIDANCE['medium'])}
         
-        rhythm_guidance = {
-            'simple': 'Mostly quarter and eighth notes, minimal syncopation',
-            'medium': 'Mix of note values, moderate syncopation, some rests',
-            'complex': 'Complex rhythmic patterns, polyrhythms, advanced syncopation'
-        }
+        {rag_pattern_instructions}
+        
+        GENRE-SPECIFIC MELODIC REQUIREMENTS FOR {genre.upper()}:
+        """]
+    
+    # Add genre-specific melodic guidance
+    genre_lower = genre.lower()
+    prompt_parts.append(next((block for keyword, block in _GENRE_MELODY_BLOCKS if keyword in genre_lower), _POP_MELODY))
+    
+    prompt_parts.append(f"""
+        
+        TEMPO-SPECIFIC RHYTHMIC REQUIREMENTS FOR {tempo} BPM:
+        """)
+    
+    # Add tempo-specific rhythmic guidance
+    prompt_parts.append(next((block for limit, block in _TEMPO_RHYTHM_BLOCKS if tempo < limit), _VERY_FAST_TEMPO_RHYTHM))
+    
+    prompt_parts.append(rag_pattern_instructions)
+    
+    prompt_parts.append(f"""
+        
+        REQUIREMENTS:
+        1. Create melodic content that spans the FULL {duration} minutes ({duration * 60} seconds)
+        2. Include rests and phrase breaks for musical breathing
+        3. Vary velocity (40-120) to create dynamic expression that matches {mood} mood
+        4. Use natural pitch transitions without sudden jumps (unless stylistically appropriate)
+        5. Include section transitions and connecting phrases
+        6. Add fills, runs, or ornaments where stylistically appropriate
+        7. ENSURE MELODIC CONTENT IS DISTINCTLY {genre.upper()} in character
+        8. CREATE DIFFERENT MELODIC MATERIAL FOR EACH SECTION
+        
+        Output ONLY a valid Python list of lists: [[pitch, start_time, end_time, velocity], ...]
+        
+        PITCH VALUES: MIDI numbers (C4=60, C5=72, etc.) - Ensure natural-sounding melodic contour
+        TIME VALUES: Precise seconds (e.g., 0.0, 0.5, 1.25, 2.0)
+        VELOCITY VALUES: 40-120 for dynamic expression appropriate to {mood} mood
+        
+        NO explanations, NO text, ONLY the list.
+        """)
+    
+    # Join the prompt once rather than re-copying it on every +=
+    return "".join(prompt_parts)
+
+def melody_agent(state: Any) -> Any:
+    """
+    Generate sophisticated, context-aware melodies with dynamic section variations.
+    """
+    logging.info("[MelodyAgent] Generating sophisticated melody with comprehensive context.")
+    
+    try:
+        # Extract comprehensive context
+        section_arrangement_plan = state.get('section_arrangement_plan', {})
+        structured_sections = state.get('structured_sections', [])
+        
+        # Get RAG patterns if available
+        rag_patterns = state.get('rag_patterns', {})
+        rag_melodies = rag_patterns.get('melodies', [])
+        rag_segments = rag_patterns.get('segments', [])
+        
+        logging.info(f"[MelodyAgent] Found {len(rag_melodies)} RAG melody patterns and {len(rag_segments)} segments")
+        
+        # Basic parameters
+        tempo = state.get('tempo', 120)
+        duration = state.get('duration', 2)
+        key_signature = state.get('key_signature', 'C major')
+        time_signature = state.get('time_signature', '4/4')
         
         # Extract RAG data to use for direct note generation (not just as prompt instructions)
         rag_melodies_data = []
@@ -171,10 +442,7 @@ def melody_agent(state: Any) -> Any:
             for melody in rag_melodies:
                 pattern_data = melody.get('pattern_data', {})
                 if isinstance(pattern_data, str):
-                    try:
-                        pattern_data = json.loads(pattern_data)
-                    except:
-                        pattern_data = {}
+                    pattern_data = parse_pattern_data(pattern_data)
                         
                 # Extract usable interval patterns
                 intervals = pattern_data.get('intervals', [])
@@ -195,14 +463,16 @@ def melody_agent(state: Any) -> Any:
                     # Log extracted data
                     logging.info(f"[MelodyAgent] Extracted {len(intervals)} intervals from RAG melody")
             
-            # Second priority: Get actual notes from segments
+            # Second priority: Get actual notes from segments; the accumulators are
+            # extended from a doubly nested loop, so bind their methods once
+            add_segment_notes = rag_segment_notes.append
+            add_actual_notes = rag_actual_notes.extend
+            add_intervals = rag_intervals.extend
+            add_rhythms = rag_rhythms.extend
             for segment in rag_segments:
                 pattern_data = segment.get('pattern_data', {})
                 if isinstance(pattern_data, str):
-                    try:
-                        pattern_data = json.loads(pattern_data)
-                    except:
-                        pattern_data = {}
+                    pattern_data = parse_pattern_data(pattern_data)
                 
                 # Extract instrument data containing notes
                 instruments = pattern_data.get('instruments', [])
@@ -215,179 +485,33 @@ def melody_agent(state: Any) -> Any:
                     
                     # Add to our collections if they contain data
                     if notes:
-                        rag_segment_notes.append({
+                        add_segment_notes({
                             'notes': notes,
                             'instrument': inst.get('name', 'Unknown'),
                             'source': segment.get('source_file', 'unknown')
                         })
-                        rag_actual_notes.extend(notes)
+                        add_actual_notes(notes)
                         logging.info(f"[MelodyAgent] Extracted {len(notes)} notes from RAG segment instrument {inst.get('name', 'Unknown')}")
                     
                     if melodic_intervals:
-                        rag_intervals.extend(melodic_intervals)
+                        add_intervals(melodic_intervals)
                     
                     if rhythm_pattern:
-                        rag_rhythms.extend(rhythm_pattern)
+                        add_rhythms(rhythm_pattern)
                         
                     if note_sequence:
-                        rag_actual_notes.extend(note_sequence)
-        
-        # Create summarized prompt instructions from extracted data
-        rag_pattern_instructions = ""
-        
-        if rag_melodies_data or rag_segment_notes:
-            rag_pattern_instructions = "\n\nIMPORTANT: INCORPORATING THESE RAG MELODIC PATTERNS:\n"
-            
-            if rag_melodies_data:
-                rag_pattern_instructions += "\nMELODIC INTERVAL PATTERNS USED:\n"
-                for i, melody in enumerate(rag_melodies_data[:2]):
-                    rag_pattern_instructions += f"- Pattern {i+1}: Using {len(melody['intervals'])} intervals from {melody['instrument']} source\n"
-            
-            if rag_segment_notes:
-                rag_pattern_instructions += "\nACTUAL NOTE SEQUENCES USED:\n"
-                for i, segment in enumerate(rag_segment_notes[:2]):
-                    rag_pattern_instructions += f"- Sequence {i+1}: Using {len(segment['notes'])} notes from {segment['instrument']}\n"
+                        add_actual_notes(note_sequence)
         
         # Log what we found for debugging
         logging.info(f"[MelodyAgent] RAG data summary: {len(rag_intervals)} intervals, {len(rag_actual_notes)} notes, {len(rag_rhythms)} rhythm patterns")
         
-        final_prompt = f"""
-        {context_description}
-        
-        {section_instructions}
-        
-        COMPLEXITY GUIDELINES:
-        - Melodic: {complexity_guidance.get(harmonic_complexity, complexity_guidance['medium'])}
-        - Rhythmic: {rhythm_guidance.get(rhythmic_complexity, rhythm_guidance['medium'])}
-        
-        {rag_pattern_instructions}
-        
-        GENRE-SPECIFIC MELODIC REQUIREMENTS FOR {genre.upper()}:
-        """
-        
-        # Add genre-specific melodic guidance
-        genre_lower = genre.lower()
-        if 'metal' in genre_lower or 'rock' in genre_lower:
-            final_prompt += """
-        - Use aggressive melodic intervals and power-chord friendly notes
-        - Include fast scalar runs and chromatic passing tones
-        - Emphasize strong downbeats and syncopated rhythms
-        - Use palm-muted sections and sustained power notes
-        - Include dramatic octave leaps and aggressive bends
-        - Pitch range: 45-75 (melody should complement guitar, not compete)
-        """
-        elif 'jazz' in genre_lower:
-            final_prompt += """
-        - Use complex chord tones, extensions (9ths, 11ths, 13ths)
-        - Include blue notes, chromatic approach tones
-        - Swing rhythm patterns with triplet subdivisions
-        - Sophisticated harmonic movement and voice leading
-        - Pitch range: 55-85 (jazz melody range)
-        """
-        elif 'classical' in genre_lower:
-            final_prompt += """
-        - Use stepwise motion with tasteful leaps
-        - Classical phrase structures with clear cadences
-        - Ornamentations like trills, turns, grace notes
-        - Balanced melodic contour with arch-like phrases
-        - Pitch range: 55-80 (classical melody range)
-        """
-        elif 'electronic' in genre_lower or 'edm' in genre_lower:
-            final_prompt += """
-        - Use synthesizer-friendly intervals and patterns
-        - Include filter sweeps, arpeggiated sequences
-        - Rhythmic patterns aligned to electronic beats
-        - Repetitive but evolving melodic phrases
-        - Pitch range: 50-90 (wide electronic range)
-        """
-        elif 'blues' in genre_lower:
-            final_prompt += """
-        - Heavily use blue notes (♭3, ♭5, ♭7)
-        - Call-and-response melodic phrases
-        - Bending and sliding between pitches
-        - 12-bar blues structure awareness
-        - Pitch range: 50-75 (blues vocal/instrumental range)
-        """
-        elif 'folk' in genre_lower or 'country' in genre_lower:
-            final_prompt += """
-        - Simple, singable melodic lines
-        - Pentatonic and modal scales
-        - Clear phrase structure with repetition
-        - Natural speech rhythm patterns
-        - Pitch range: 55-75 (vocal-friendly range)
-        """
-        else:  # Pop/other
-            final_prompt += """
-        - Catchy, memorable melodic hooks
-        - Mix of stepwise motion and moderate leaps
-        - Clear phrase structure with repetition and variation
-        - Accessible melodic content for broad appeal
-        - Pitch range: 55-78 (pop melody range)
-        """
-        
-        final_prompt += f"""
-        
-        TEMPO-SPECIFIC RHYTHMIC REQUIREMENTS FOR {tempo} BPM:
-        """
-        
-        # Add tempo-specific rhythmic guidance
-        if tempo < 80:
-            final_prompt += """
-        - Use longer note values (half notes, whole notes)
-        - Include expressive rubato and ritardando
-        - Fewer but more meaningful melodic events
-        - Allow for breath and space between phrases
-        """
-        elif tempo < 120:
-            final_prompt += """
-        - Balanced mix of quarter and eighth notes
-        - Moderate rhythmic activity with clear pulse
-        - Natural breathing points in phrases
-        - Syncopation for interest but not overwhelming
-        """
-        elif tempo < 160:
-            final_prompt += """
-        - Emphasis on eighth and sixteenth note patterns
-        - Active rhythmic movement with driving pulse
-        - Quick melodic passages and energetic phrases
-        - Strategic use of rests for rhythmic punch
-        """
-        else:  # Very fast tempo
-            final_prompt += """
-        - Rapid sixteenth note passages and scalar runs
-        - Aggressive rhythmic patterns with strong accents
-        - Short, punchy melodic cells repeated and developed
-        - Minimal rests - continuous melodic energy
-        """
-        
-        final_prompt += rag_pattern_instructions
-        
-        final_prompt += f"""
-        
-        REQUIREMENTS:
-        1. Create melodic content that spans the FULL {duration} minutes ({duration * 60} seconds)
-        2. Include rests and phrase breaks for musical breathing
-        3. Vary velocity (40-120) to create dynamic expression that matches {mood} mood
-        4. Use natural pitch transitions without sudden jumps (unless stylistically appropriate)
-        5. Include section transitions and connecting phrases
-        6. Add fills, runs, or ornaments where stylistically appropriate
-        7. ENSURE MELODIC CONTENT IS DISTINCTLY {genre.upper()} in character
-        8. CREATE DIFFERENT MELODIC MATERIAL FOR EACH SECTION
-        
-        Output ONLY a valid Python list of lists: [[pitch, start_time, end_time, velocity], ...]
-        
-        PITCH VALUES: MIDI numbers (C4=60, C5=72, etc.) - Ensure natural-sounding melodic contour
-        TIME VALUES: Precise seconds (e.g., 0.0, 0.5, 1.25, 2.0)
-        VELOCITY VALUES: 40-120 for dynamic expression appropriate to {mood} mood
-        
-        NO explanations, NO text, ONLY the list.
-        """
         
         # DIRECT RAG USAGE: Two approaches depending on available data
         # 1. If we have actual RAG notes, use them directly with modifications
         # 2. Otherwise, generate with LLM but apply musical constraints from RAG data
         
         notes = []
+        note_fields = _DICT_NOTE_FIELDS
         used_rag_directly = False
         
         # First option: Use actual RAG note data directly if available
@@ -437,43 +561,50 @@ def melody_agent(state: Any) -> Any:
                     current_duration = rag_notes[-1]['end']
                     time_scale = target_duration / current_duration
                     
+                    # Slight velocity variation for expression, drawn for all notes in one call
+                    velocity_jitter = random.choices(_VELOCITY_JITTER, k=len(rag_notes))
+                    
                     # Apply time scaling and add phrasing/variation
-                    for note in rag_notes:
+                    for note, jitter in zip(rag_notes, velocity_jitter):
                         note['start'] *= time_scale
                         note['end'] *= time_scale
-                        
-                        # Add slight velocity variation for expression
-                        note['velocity'] = max(40, min(120, note['velocity'] + random.randint(-10, 10)))
+                        note['velocity'] = max(40, min(120, note['velocity'] + jitter))
                     
                     # Divide notes into sections based on structured_sections
                     if structured_sections and len(structured_sections) > 1:
                         # Create section variations
                         section_notes = []
+                        
+                        # Sort once (stable, and already in order unless RAG durations were negative) so each
+                        # section's notes are one contiguous run [lo, hi) that binary search finds
+                        rag_notes.sort(key=lambda n: n['start'])
+                        note_starts = [n['start'] for n in rag_notes]
+                        section_runs = []
                         for i, section in enumerate(structured_sections):
-                            section_start = section['start_time']
-                            section_end = section['end_time']
-                            
-                            # Find notes in this section time range
-                            section_raw_notes = [n for n in rag_notes if section_start <= n['start'] < section_end]
-                            
-                            # If we have notes for this section, process them
-                            if section_raw_notes:
-                                # Apply section-specific transformations
-                                for note in section_raw_notes:
-                                    # For variation, transpose notes slightly for different sections
-                                    if i % 3 == 1:  # Every third section, transpose up
-                                        note['pitch'] += 2  # Major second up
-                                    elif i % 3 == 2:  # Every third section, transpose down
-                                        note['pitch'] -= 2  # Major second down
-                                    
-                                    # Adjust velocities based on section energy
-                                    section_plan = section_arrangement_plan.get(section['name'], {})
-                                    energy_level = section_plan.get('energy_level', 5)
-                                    velocity_adjust = (energy_level - 5) * 5  # -25 to +25
-                                    note['velocity'] = max(40, min(120, note['velocity'] + velocity_adjust))
-                                
-                                # Add the processed notes
-                                section_notes.extend(section_raw_notes)
+                            lo = bisect_left(note_starts, section['start_time'])
+                            hi = bisect_left(note_starts, section['end_time'])
+                            if lo < hi:
+                                # Transpose for variation and adjust velocities based on section energy
+                                section_plan = section_arrangement_plan.get(section['name'], {})
+                                energy_level = section_plan.get('energy_level', 5)
+                                velocity_adjust = (energy_level - 5) * 5  # -25 to +25
+                                section_runs.append((lo, hi, _SECTION_PITCH_SHIFTS[i % 3], velocity_adjust))
+                        
+                        if section_runs:
+                            # Apply every run to pitch/velocity columns, in section order so overlapping
+                            # sections still compound, then write the results back to the notes once.
+                            # Velocities are adjusted as floats (energy levels may be fractional) and
+                            # rounded back to MIDI integers at the write-back.
+                            pitches = np.array([n['pitch'] for n in rag_notes])
+                            velocities = np.array([n['velocity'] for n in rag_notes], dtype=np.float64)
+                            for lo, hi, pitch_shift, velocity_adjust in section_runs:
+                                pitches[lo:hi] += pitch_shift
+                                np.clip(velocities[lo:hi] + velocity_adjust, 40, 120, out=velocities[lo:hi])
+                            for note, pitch, velocity in zip(rag_notes, pitches.tolist(),
+                                                             np.rint(velocities).astype(np.int64).tolist()):
+                                note['pitch'] = pitch
+                                note['velocity'] = velocity
+                            section_notes = [note for lo, hi, _, _ in section_runs for note in rag_notes[lo:hi]]
                         
                         # If we successfully created section variations
                         if section_notes:
@@ -512,14 +643,19 @@ def melody_agent(state: Any) -> Any:
                 # Generate notes using the interval patterns
                 target_duration = duration * 60  # in seconds
                 
-                # Create notes using interval patterns
+                # The walk can take thousands of steps on long pieces, so bind the
+                # sampling helpers once instead of resolving them on every step, and
+                # draw intervals and velocities from the pools a block at a time
+                choice = random.choice
+                chance = random.random
+                next_interval = draw_in_blocks(rag_intervals).__next__
+                next_velocity = draw_in_blocks(_WALK_VELOCITIES).__next__
+                add_note = interval_notes.append
+                
+                # Create notes using interval patterns (this branch only runs with intervals available)
                 while current_time < target_duration:
                     # Get an interval from our collection
-                    if rag_intervals:
-                        interval = random.choice(rag_intervals)
-                    else:
-                        # Fallback to common intervals if none available
-                        interval = random.choice([-2, -1, 0, 1, 2])
+                    interval = next_interval()
                     
                     # Apply the interval to get next pitch
                     next_pitch = current_pitch + interval
@@ -531,17 +667,17 @@ def melody_agent(state: Any) -> Any:
                         next_pitch -= 12  # Down an octave
                     
                     # Get a duration
-                    if rag_rhythms and random.random() < 0.7:  # 70% chance to use RAG rhythm
-                        duration = random.choice(rag_rhythms)
+                    if rag_rhythms and chance() < 0.7:  # 70% chance to use RAG rhythm
+                        duration = choice(rag_rhythms)
                     else:
-                        duration = random.choice(durations)
+                        duration = choice(durations)
                     
                     # Add the note
-                    interval_notes.append({
+                    add_note({
                         'pitch': next_pitch,
                         'start': current_time,
                         'end': current_time + duration,
-                        'velocity': random.randint(70, 90)
+                        'velocity': next_velocity()
                     })
                     
                     # Move to next position
@@ -549,8 +685,8 @@ def melody_agent(state: Any) -> Any:
                     current_pitch = next_pitch
                     
                     # Occasionally add a rest for phrasing
-                    if random.random() < 0.15:  # 15% chance of a rest
-                        current_time += random.choice([0.25, 0.5])
+                    if chance() < 0.15:  # 15% chance of a rest
+                        current_time += choice(_REST_LENGTHS)
                 
                 # If we have enough notes
                 if interval_notes and len(interval_notes) > 10:
@@ -565,33 +701,42 @@ def melody_agent(state: Any) -> Any:
         # Third option (fallback): Generate with LLM if direct methods failed
         if not used_rag_directly:
             logging.info(f"[MelodyAgent] Falling back to LLM generation with RAG guidance")
+            final_prompt = build_melody_prompt(state, rag_melodies_data, rag_segment_notes)
             logging.info(f"[MelodyAgent] Generating melody with prompt length: {len(final_prompt)} characters")
-            melody_text = gemini_generate(final_prompt)
+            melody_text = cached_gemini_generate(final_prompt)
             logging.info(f"[MelodyAgent] Raw Gemini output preview: {melody_text[:200]}...")
             
             cleaned = clean_llm_output(melody_text)
             notes_array = safe_literal_eval(cleaned)
-            notes = notes_array_to_dicts(notes_array)
+            
+            # Keep the parsed rows as they are; the note dicts are built once after post-processing
+            notes = [n for n in notes_array if isinstance(n, (list, tuple)) and len(n) == 4]
+            note_fields = _ROW_NOTE_FIELDS
         
         # Post-process and validate notes
         if notes:
-            # Sort by start time
-            notes.sort(key=lambda n: n['start'])
+            pitch_field, start_field, end_field, velocity_field = note_fields
+            starts = np.fromiter((note[start_field] for note in notes), np.float64, len(notes))
+            ends = np.fromiter((note[end_field] for note in notes), np.float64, len(notes))
             
-            # Quantize note timings
-            for note in notes:
-                note['start'] = quantize_time(note['start'])
-                note['end'] = quantize_time(note['end'])
-                
-                # Ensure minimum note duration
-                if note['end'] <= note['start']:
-                    note['end'] = note['start'] + 0.25
-                    
-                # Validate velocity range
-                note['velocity'] = max(40, min(120, note['velocity']))
+            # Sort by start time (stable, like list.sort), only when the notes are out of order
+            if np.any(starts[1:] < starts[:-1]):
+                order = np.argsort(starts, kind='stable')
+                notes = [notes[i] for i in order.tolist()]
+                starts = starts[order]
+                ends = ends[order]
+            
+            # Quantize timings, fix zero durations and clamp velocities in one pass over the columns
+            velocities, onsets = finalize_note_columns(starts, ends, np.array([note[velocity_field] for note in notes]))
+            note_onsets = onsets.tolist()
+
+            notes = [
+                {'pitch': note[pitch_field], 'start': start, 'end': end, 'velocity': velocity}
+                for note, start, end, velocity in zip(notes, starts.tolist(), ends.tolist(), velocities.tolist())
+            ]
             
             # Check coverage
-            max_end = max(n['end'] for n in notes)
+            max_end = float(ends.max())
             target_duration = duration * 60
             coverage_ratio = max_end / target_duration
             
@@ -603,16 +748,15 @@ def melody_agent(state: Any) -> Any:
         else:
             logging.error("[MelodyAgent] No valid notes generated!")
             notes = []
+            note_onsets = []
         
         # Calculate structural information
         tempo = state.get('tempo', 120)
         beats_per_bar = 4 if time_signature.startswith('4') else 3
         seconds_per_beat = 60.0 / tempo
         total_beats = int((duration * 60) / seconds_per_beat)
-        bar_times = [quantize_time(i * beats_per_bar * seconds_per_beat) 
-                    for i in range(math.ceil(total_beats / beats_per_bar))]
-        
-        note_onsets = sorted(set([quantize_time(n['start']) for n in notes])) if notes else []
+        bar_count = math.ceil(total_beats / beats_per_bar)
+        bar_times = (np.rint(np.arange(bar_count) * beats_per_bar * seconds_per_beat * 4.0) * 0.25).tolist()
         
         melody_track = {
             'name': 'Melody',
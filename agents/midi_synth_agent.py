@@ -18,23 +18,19 @@ def midi_synth_agent(state: Any) -> Any:
         backing_instruments = state.get('backing_instruments', [])
         vocals_enabled = state.get('vocals', False)
         
-        # Create comprehensive list of allowed instruments
-        allowed_instruments = set()
-        for instr in requested_instruments:
-            allowed_instruments.add(instr.lower().strip())
+        # Create comprehensive list of allowed instruments (a dict keeps request order for the log
+        # while giving set-speed membership)
+        allowed_instruments = dict.fromkeys(instr.lower().strip() for instr in requested_instruments)
         
         if lead_instrument:
-            allowed_instruments.add(lead_instrument.lower().strip())
+            allowed_instruments[lead_instrument.lower().strip()] = None
         
-        for instr in backing_instruments:
-            allowed_instruments.add(instr.lower().strip())
+        allowed_instruments.update(dict.fromkeys(instr.lower().strip() for instr in backing_instruments))
         
         # Always allow drums and melody track
-        allowed_instruments.add('drums')
-        allowed_instruments.add('melody')
-        allowed_instruments.add('chords')
+        allowed_instruments.update(dict.fromkeys(('drums', 'melody', 'chords')))
         
-        logging.info(f"[MIDISynthAgent] Allowed instruments: {allowed_instruments}")
+        logging.info(f"[MIDISynthAgent] Allowed instruments: {list(allowed_instruments)}")
         
         # Collect all tracks from state with strict filtering
         tracks = []
@@ -58,14 +54,12 @@ def midi_synth_agent(state: Any) -> Any:
                 track_name = track.get('name', '').lower()
                 track_instrument = track.get('instrument', '').lower()
                 
-                # Check if this track matches any allowed instrument
-                is_allowed = False
-                for allowed_instr in allowed_instruments:
-                    if (allowed_instr in track_name or 
-                        allowed_instr in track_instrument or
-                        allowed_instr == track_instrument):
-                        is_allowed = True
-                        break
+                # Check if this track matches any allowed instrument: exact names are a single
+                # lookup, otherwise fall back to a substring match on the name or instrument
+                is_allowed = track_instrument in allowed_instruments or any(
+                    allowed_instr in track_name or allowed_instr in track_instrument
+                    for allowed_instr in allowed_instruments
+                )
                 
                 if is_allowed and track.get('notes'):
                     tracks.append(track)
@@ -88,10 +82,12 @@ def midi_synth_agent(state: Any) -> Any:
         
         # Validate tracks have content
         valid_tracks = []
+        note_counts = []
         for track in tracks:
-            notes = track.get('notes', [])
-            if notes and len(notes) > 0:
+            notes = track.get('notes') or ()
+            if notes:
                 valid_tracks.append(track)
+                note_counts.append(len(notes))
             else:
                 logging.warning(f"[MIDISynthAgent] Skipping empty track: {track.get('name', 'Unknown')}")
         
@@ -113,9 +109,8 @@ def midi_synth_agent(state: Any) -> Any:
         
         # Log track summary
         track_summary = []
-        for track in valid_tracks:
+        for track, note_count in zip(valid_tracks, note_counts):
             track_name = track.get('name', 'Unknown')
-            note_count = len(track.get('notes', []))
             track_summary.append(f"{track_name} ({note_count} notes)")
         
         logging.info(f"[MIDISynthAgent] Final tracks: {', '.join(track_summary)}")
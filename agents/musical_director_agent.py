@@ -5,6 +5,14 @@ from utils.state_utils import validate_agent_return, safe_state_update
 import json
 import re
 
+_FENCE_RE = re.compile(r"^```[a-zA-Z]*\n?|```$", re.MULTILINE)
+# Trailing commas before '}' or ']' are dropped in one pass, keeping the closing bracket
+_TRAILING_COMMA_RE = re.compile(r",\s*([}\]])")
+_CONTROL_CHARS_RE = re.compile(r"[\x00-\x1f\x7f-\x9f]")
+_LINE_COMMENT_RE = re.compile(r"//.*?\n")
+_NESTED_OBJECT_RE = re.compile(r"({[^{}]*(?:{[^{}]*}[^{}]*)*})", re.DOTALL)
+_OBJECT_RE = re.compile(r"(\{.*\})", re.DOTALL)
+
 def safe_json_parse(text):
     """Safely parse JSON with multiple fallback attempts"""
     try:
@@ -15,18 +23,17 @@ def safe_json_parse(text):
         # Try to fix common issues
         try:
             # Remove trailing commas
-            fixed_text = re.sub(r',\s*}', '}', text)
-            fixed_text = re.sub(r',\s*]', ']', fixed_text)
+            fixed_text = _TRAILING_COMMA_RE.sub(r'\1', text)
             # Remove control characters
-            fixed_text = re.sub(r'[\x00-\x1f\x7f-\x9f]', '', fixed_text)
+            fixed_text = _CONTROL_CHARS_RE.sub('', fixed_text)
             # Remove comments
-            fixed_text = re.sub(r'//.*?\n', '\n', fixed_text)
+            fixed_text = _LINE_COMMENT_RE.sub('\n', fixed_text)
             return json.loads(fixed_text)
         except json.JSONDecodeError:
             # Try to extract just the inner content
             try:
                 # Look for the main JSON structure
-                match = re.search(r'({[^{}]*(?:{[^{}]*}[^{}]*)*})', text, re.DOTALL)
+                match = _NESTED_OBJECT_RE.search(text)
                 if match:
                     return json.loads(match.group(1))
             except json.JSONDecodeError:
@@ -39,16 +46,15 @@ def safe_json_parse(text):
 def clean_llm_output(text):
     """Clean LLM output and extract JSON if present"""
     # Remove code blocks
-    cleaned = re.sub(r'^```[a-zA-Z]*\n?|```$', '', text.strip(), flags=re.MULTILINE).strip()
+    cleaned = _FENCE_RE.sub('', text.strip()).strip()
     
     # Try to extract JSON from the text
-    json_match = re.search(r'(\{.*\})', cleaned, re.DOTALL)
+    json_match = _OBJECT_RE.search(cleaned)
     if json_match:
         json_text = json_match.group(1)
         # Clean up common LLM JSON issues
-        json_text = re.sub(r',\s*}', '}', json_text)  # Remove trailing commas
-        json_text = re.sub(r',\s*]', ']', json_text)  # Remove trailing commas in arrays
-        json_text = re.sub(r'[\x00-\x1f\x7f-\x9f]', '', json_text)  # Remove control characters
+        json_text = _TRAILING_COMMA_RE.sub(r'\1', json_text)  # Remove trailing commas in objects and arrays
+        json_text = _CONTROL_CHARS_RE.sub('', json_text)  # Remove control characters
         return json_text
     
     return cleaned
@@ -2,30 +2,33 @@ import logging
 from typing import Any
 from utils.gemini_llm import gemini_generate
 from utils.state_utils import validate_agent_return, safe_state_update
+from utils.midi_utils import nearest_onsets
 import ast
 import re
-from transformers import pipeline
+import numpy as np
 import soundfile as sf
 import os
 
+_FENCE_RE = re.compile(r"^```[a-zA-Z]*\n?|```$", re.MULTILINE)
+
 def clean_llm_output(text):
-    return re.sub(r"^```[a-zA-Z]*\n?|```$", "", text.strip(), flags=re.MULTILINE).strip()
+    return _FENCE_RE.sub("", text.strip()).strip()
 
 def safe_literal_eval(text):
-    # Try normal parse
+    # Auto-close truncated output before the first parse
+    missing_square = text.count('[') - text.count(']')
+    missing_curly = text.count('{') - text.count('}')
+    if missing_square > 0 or missing_curly > 0:
+        repaired = text + (']' * max(missing_square, 0)) + ('}' * max(missing_curly, 0))
+        try:
+            return ast.literal_eval(repaired)
+        except Exception:
+            pass  # Fall back to the raw text
     try:
         return ast.literal_eval(text)
-    except Exception:
-        # Try to auto-close brackets
-        if text.count('[') > text.count(']'):
-            text = text + (']' * (text.count('[') - text.count(']')))
-        if text.count('{') > text.count('}'):
-            text = text + ('}' * (text.count('{') - text.count('}')))
-        try:
-            return ast.literal_eval(text)
-        except Exception as e:
-            logging.error(f"[VocalAgent] Failed to parse LLM output after auto-fix: {e}")
-            return []
+    except Exception as e:
+        logging.error(f"[VocalAgent] Failed to parse LLM output after auto-fix: {e}")
+        return []
 
 def notes_array_to_dicts(notes_array):
     return [
@@ -73,9 +76,10 @@ def vocal_agent(state: Any) -> Any:
         notes_array = safe_literal_eval(cleaned)
         notes = notes_array_to_dicts(notes_array)
         # Optionally, quantize note start times to melody_onsets
-        for n in notes:
-            if melody_onsets:
-                n['start'] = min(melody_onsets, key=lambda t: abs(t - n['start']))
+        if notes and melody_onsets:
+            starts = np.fromiter((n['start'] for n in notes), np.float64, len(notes))
+            for n, onset in zip(notes, nearest_onsets(starts, melody_onsets).tolist()):
+                n['start'] = onset
         # Warn if notes do not cover the full song duration
         duration = state.get('duration', 2)
         if notes:
@@ -95,6 +99,9 @@ def vocal_agent(state: Any) -> Any:
 
         # --- TTS VOCALS PATCH ---
         try:
+            # transformers (and torch behind it) is imported only when vocals are synthesized,
+            # so importing the agents does not pay its start-up cost
+            from transformers import pipeline
             tts = pipeline("text-to-speech", "suno/bark")
             tts_out = tts(lyrics)
             audio = tts_out["audio"]
@@ -1,4 +1,10 @@
 import os
+import hashlib
+import logging
+import shelve
+import threading
+from functools import lru_cache
+from typing import Iterator
 from langchain_google_genai import ChatGoogleGenerativeAI
 from dotenv import load_dotenv
 
@@ -9,6 +15,86 @@ llm = ChatGoogleGenerativeAI(
     # google_api_key=os.environ["GOOGLE_API_KEY"]
 )
 
+# Persistent response cache, keyed by a hash of the prompt, so identical requests across runs skip the network.
+# It is opt-in (ORCHESTRAITE_LLM_DISK_CACHE=1): with it on, the same description gives the same song every run.
+LLM_CACHE_PATH = os.path.join('output', '.llm_cache')
+LLM_DISK_CACHE_ENABLED = os.environ.get('ORCHESTRAITE_LLM_DISK_CACHE', '0') == '1'
+# Set ORCHESTRAITE_LLM_CACHE=0 to always call the model, e.g. when iterating on nondeterministic prompts
+LLM_CACHE_ENABLED = os.environ.get('ORCHESTRAITE_LLM_CACHE', '1') != '0'
+_cache_lock = threading.Lock()
+
 def gemini_generate(prompt: str) -> str:
     response = llm.invoke(prompt)
-    return response.content if hasattr(response, "content") else str(response) 
\ No newline at end of file
+    return response.content if hasattr(response, "content") else str(response)
+
+def gemini_generate_stream(prompt: str) -> Iterator[str]:
+    """Yield the response text chunk by chunk as the model produces it."""
+    for chunk in llm.stream(prompt):
+        yield chunk.content if hasattr(chunk, "content") else str(chunk)
+
+def prompt_cache_key(prompt: str) -> str:
+    return hashlib.blake2b(prompt.encode('utf-8'), digest_size=16).hexdigest()
+
+def _read_cache(key: str):
+    if not LLM_DISK_CACHE_ENABLED:
+        return None
+    with _cache_lock:
+        try:
+            with shelve.open(LLM_CACHE_PATH, flag='r') as cache:
+                return cache.get(key)
+        except Exception:
+            return None  # No cache file yet, or it cannot be read
+
+def _write_cache(key: str, text: str) -> None:
+    if not text or not LLM_DISK_CACHE_ENABLED:
+        return
+    with _cache_lock:
+        try:
+            os.makedirs(os.path.dirname(LLM_CACHE_PATH), exist_ok=True)
+            with shelve.open(LLM_CACHE_PATH) as cache:
+                cache[key] = text
+        except Exception as e:
+            logging.warning(f"[GeminiLLM] Could not write LLM cache: {e}")
+
+def cached_gemini_generate(prompt: str) -> str:
+    """
+    gemini_generate memoized in memory, and on disk when LLM_DISK_CACHE_ENABLED is on. Errors
+    are never cached and empty responses are not written to disk, so a failed call is retried
+    on the next run. Both layers are skipped when LLM_CACHE_ENABLED is off.
+    """
+    if not LLM_CACHE_ENABLED:
+        return gemini_generate(prompt)
+    return _memoized_gemini_generate(prompt)
+
+@lru_cache(maxsize=1024)
+def _memoized_gemini_generate(prompt: str) -> str:
+    key = prompt_cache_key(prompt)
+    cached = _read_cache(key)
+    if cached is not None:
+        return cached
+
+    text = gemini_generate(prompt)
+    _write_cache(key, text)
+    return text
+
+def cached_gemini_generate_stream(prompt: str) -> Iterator[str]:
+    """
+    Streaming counterpart of cached_gemini_generate sharing its on-disk cache: a cached
+    response comes back as a single chunk, a fresh one is stored once it has fully arrived.
+    Without the disk cache every call streams straight from the model.
+    """
+    if not LLM_CACHE_ENABLED or not LLM_DISK_CACHE_ENABLED:
+        yield from gemini_generate_stream(prompt)
+        return
+
+    key = prompt_cache_key(prompt)
+    cached = _read_cache(key)
+    if cached is not None:
+        yield cached
+        return
+
+    chunks = []
+    for chunk in gemini_generate_stream(prompt):
+        chunks.append(chunk)
+        yield chunk
+    _write_cache(key, "".join(chunks))
@@ -1,6 +1,8 @@
 import re
 from typing import List, Dict
 
+_SECTION_MARKER_RE = re.compile(r"\[(.+?)\]", re.IGNORECASE)
+
 def parse_lyrics_sections(lyrics: str) -> List[Dict]:
     """
     Parse lyrics for section markers (e.g., [Verse], [Chorus], [Bridge], etc.)
@@ -10,7 +12,7 @@ def parse_lyrics_sections(lyrics: str) -> List[Dict]:
     sections = []
     current_section = None
     for idx, line in enumerate(lines):
-        match = re.match(r"\[(.+?)\]", line.strip(), re.IGNORECASE)
+        match = _SECTION_MARKER_RE.match(line.strip())
         if match:
             if current_section:
                 current_section['end'] = idx
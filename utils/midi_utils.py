@@ -3,11 +3,14 @@ from typing import Any, List, Dict
 import pretty_midi
 import os
 import re
+import numpy as np
+
+_NOTE_NAME_RE = re.compile(r'^([A-Ga-g][#b]?)(-?\d+)$')
 
 # Helper function to convert note name (e.g., 'E3') to MIDI number
 NOTE_NAME_TO_MIDI = {'C': 0, 'C#': 1, 'Db': 1, 'D': 2, 'D#': 3, 'Eb': 3, 'E': 4, 'F': 5, 'F#': 6, 'Gb': 6, 'G': 7, 'G#': 8, 'Ab': 8, 'A': 9, 'A#': 10, 'Bb': 10, 'B': 11}
 def note_name_to_midi(note_name):
-    match = re.match(r'^([A-Ga-g][#b]?)(-?\d+)$', note_name)
+    match = _NOTE_NAME_RE.match(note_name)
     if not match:
         return None
     name = match.group(1).capitalize()
@@ -16,6 +19,14 @@ def note_name_to_midi(note_name):
         return None
     return 12 * (octave + 1) + NOTE_NAME_TO_MIDI[name]
 
+def nearest_onsets(starts, onsets):
+    """Closest onset for every start time, via binary search on the sorted onsets."""
+    onsets = np.sort(np.asarray(onsets, dtype=np.float64))
+    idx = np.searchsorted(onsets, starts)
+    left = onsets[np.maximum(idx - 1, 0)]
+    right = onsets[np.minimum(idx, len(onsets) - 1)]
+    return np.where(np.abs(starts - left) <= np.abs(starts - right), left, right)
+
 def create_midi_file(tracks: List[Dict[str, Any]], tempo: int = 120) -> pretty_midi.PrettyMIDI:
     """
     Create a PrettyMIDI object from a list of track dicts.
@@ -28,7 +39,7 @@ def create_midi_file(tracks: List[Dict[str, Any]], tempo: int = 120) -> pretty_m
         is_drum = track.get('is_drum', False)
         name = track.get('name', 'Instrument')
         instrument = pretty_midi.Instrument(program=program, is_drum=is_drum, name=name)
-        for note in track.get('notes', []):
+        for note in track.get('notes') or ():
             # Ensure pitch and velocity are valid MIDI integers, handle string values and note names
             raw_pitch = note['pitch']
             if isinstance(raw_pitch, str):
@@ -68,7 +79,7 @@ def add_track_to_midi(midi_obj: pretty_midi.PrettyMIDI, track: Dict[str, Any]) -
     is_drum = track.get('is_drum', False)
     name = track.get('name', 'Instrument')
     instrument = pretty_midi.Instrument(program=program, is_drum=is_drum, name=name)
-    for note in track.get('notes', []):
+    for note in track.get('notes') or ():
         # Ensure pitch and velocity are valid MIDI integers, handle string values and note names
         raw_pitch = note['pitch']
         if isinstance(raw_pitch, str):